@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 import argparse
 import atexit
+import gzip
+import hashlib
+import json
 import logging
 import logging.handlers
+import queue
+import signal
+import socket
 import sys
+import threading
 import time
+import uuid
+from contextlib import contextmanager
 
 # Look for debug flag
 if "-d" in sys.argv or "--debug" in sys.argv:
@@ -18,29 +27,45 @@ else:
 # Set root logger level
 root_log: logging.Logger = logging.getLogger()
 root_log.setLevel(log_level)
+# Logger for messages from this module
+log: logging.Logger = logging.getLogger(__name__)
+
+# Skip collecting process info for every log record, as we never log it.
+# (Thread names are kept, as our log format includes them.)
+logging.logProcesses = False
+logging.logMultiprocessing = False
 
 
 import os
-from datetime import datetime
+from typing import Optional, Tuple
 
-import pkg_resources
-from flask import abort, send_file, request
-from flask_cors import CORS, cross_origin
+from flask import Response, abort, request, send_file
+from flask_cors import CORS
 from labthings import create_app
-from labthings.extensions import find_extensions
+from labthings.extensions import find_extensions_in_file
 from labthings.views import View
 
-from openflexure_microscope.api.utilities import init_default_extensions, list_routes
+from openflexure_microscope.api.utilities import (
+    find_extension_paths,
+    get_bool,
+    init_default_extensions,
+    list_routes,
+    V1GoneMiddleware,
+)
 from openflexure_microscope.api.v2 import views
 from openflexure_microscope.json import JSONEncoder
+from openflexure_microscope.config import user_settings
 from openflexure_microscope.microscope import Microscope
 from openflexure_microscope.paths import (
     OPENFLEXURE_EXTENSIONS_PATH,
     OPENFLEXURE_VAR_PATH,
     logs_file_path,
 )
+from openflexure_microscope.utilities import get_server_version
 
-from .openapi import add_spec_extras
+from .asgi import StreamsASGIApp
+from .openapi import add_spec_extras, spec_to_yaml
+from .server import PooledWSGIServer
 
 
 # Custom RotatingFileHandler subclass
@@ -80,50 +105,129 @@ access_log.propagate = False
 fh: logging.Handler = CustomRotatingFileHandler(ROOT_LOGFILE, debug=debug_app)
 # Create access log file handler
 afh: logging.Handler = CustomRotatingFileHandler(ACCESS_LOGFILE, debug=debug_app)
-# Add file handler to root logger
-root_log.addHandler(fh)
-access_log.addHandler(afh)
+# File handlers write from background threads, so that logging
+# never blocks a request thread on (slow, SD card) disk I/O
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+access_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue, fh, respect_handler_level=True
+)
+access_log_listener = logging.handlers.QueueListener(
+    access_log_queue, afh, respect_handler_level=True
+)
+log_listener.start()
+access_log_listener.start()
+# Add queue handlers to root and access loggers
+root_log.addHandler(logging.handlers.QueueHandler(log_queue))
+access_log_handler: logging.Handler = logging.handlers.QueueHandler(access_log_queue)
+access_log.addHandler(access_log_handler)
 
 # Log server paths being used
-logging.info("Running with data path %s", OPENFLEXURE_VAR_PATH)
-
-# Create the microscope object
-api_microscope: Microscope = Microscope()
-logging.debug("Restoring captures...")
-api_microscope.captures.rebuild_captures()
-logging.debug("Microscope successfully attached!")
+log.info("Running with data path %s", OPENFLEXURE_VAR_PATH)
+
+# The microscope object is created on demand by get_microscope(), so that
+# importing the app (e.g. to generate the OpenAPI spec) doesn't probe hardware
+_microscope: Optional[Microscope] = None
+_microscope_lock: threading.Lock = threading.Lock()
+rebuild_captures_thread: Optional[threading.Thread] = None
+
+# The app's title (and so its mDNS name) uses the microscope's name, which is
+# read from the settings here as the microscope doesn't exist yet. As in
+# Microscope, an unnamed microscope is named after its id, which is generated
+# if there isn't one saved, so that each microscope's title is unique.
+_saved_settings: dict = user_settings.load()
+microscope_id: str = _saved_settings.get("id", f"openflexure:microscope:{uuid.uuid4()}")
+microscope_name: str = _saved_settings.get("name", microscope_id)
 
 # Create flask app
-logging.info("Creating app")
+log.info("Creating app")
 app, labthing = create_app(
 
     __name__,
 
     #name = "/var/openflexure/application/openflexure-microscope-server/openflexure_microscope/api/app",
     prefix="/api/v2",
-    title=f"OpenFlexure Microscope {api_microscope.name}",
+    title=f"OpenFlexure Microscope {microscope_name}",
     description="Test LabThing-based API for OpenFlexure Microscope",
     types=["org.openflexure.microscope"],
-    version=pkg_resources.get_distribution("openflexure-microscope-server").version,
+    version=get_server_version(),
     flask_kwargs= {"static_url_path":'', "static_folder": "/var/openflexure/application/openflexure-microscope-server/openflexure_microscope/api/static/dist"},
 )
 
-# Enable CORS for some routes outside of LabThings
-cors: CORS = CORS(app)
+# Enable CORS for the routes outside of LabThings that clients query.
+# LabThings already handles CORS for everything under /api/v2 (including
+# streams), so a catch-all here would just process every response twice.
+# Browsers may cache preflight results for a day.
+cors: CORS = CORS(app, resources={r"/routes": {}}, max_age=86400)
+
+# If the server sits behind a web server that supports X-Sendfile (e.g. Apache
+# with mod_xsendfile, or lighttpd), let it copy files like /log to the client.
+# nginx users can instead map the logs folder to an `internal;` location and
+# use X-Accel-Redirect. Without such a front end, responses would be empty,
+# so this is only enabled if OPENFLEXURE_USE_X_SENDFILE is set.
+app.config["USE_X_SENDFILE"] = get_bool(os.getenv("OPENFLEXURE_USE_X_SENDFILE", ""))
 
 
 # Use custom JSON encoder
 labthing.json_encoder = JSONEncoder
 app.json_encoder = JSONEncoder
 
-# Add the microscope object to LabThings so extensions can access it
-labthing.add_component(api_microscope, "org.openflexure.microscope")
 
-# Attach extensions
-if not os.path.isfile(OPENFLEXURE_EXTENSIONS_PATH):
-    init_default_extensions(OPENFLEXURE_EXTENSIONS_PATH)
-for extension in find_extensions(OPENFLEXURE_EXTENSIONS_PATH):
+
+def get_microscope() -> Microscope:
+    """
+    Return the microscope, creating it and attaching it to LabThings on first use
+    """
+    global _microscope, rebuild_captures_thread  # pylint: disable=global-statement
+    with _microscope_lock:
+        if _microscope is None:
+            microscope: Microscope = Microscope()
+            # Keep a generated identity consistent with the app's title
+            if "id" not in _saved_settings:
+                microscope.id = microscope_id
+                if "name" not in _saved_settings:
+                    microscope.name = microscope_name
+            # Reload captures from disk in the background, so the server can start
+            # listening straight away. CaptureList responds 503 until this is done.
+            log.debug("Restoring captures...")
+            rebuild_captures_thread = threading.Thread(
+                target=microscope.captures.rebuild_captures,
+                name="RebuildCaptures",
+                daemon=True,
+            )
+            rebuild_captures_thread.start()
+            # Add the microscope object to LabThings so extensions can access it
+            labthing.add_component(microscope, "org.openflexure.microscope")
+            log.debug("Microscope successfully attached!")
+            _microscope = microscope
+    return _microscope
+
+
+# Make sure the microscope exists before any request is handled
+app.before_first_request(get_microscope)
+
+# Cached (JSON body, gzipped body, ETag) of the /routes response. The URL map
+# doesn't change once the app is set up, unless another extension registers
+# new views.
+_routes_cache: Optional[Tuple[bytes, bytes, str]] = None
+
+
+def invalidate_routes_cache():
+    global _routes_cache  # pylint: disable=global-statement
+    _routes_cache = None
+
+
+def register_extension(extension):
+    """Register a LabThings extension, invalidating the cached route list"""
     labthing.register_extension(extension)
+    invalidate_routes_cache()
+
+
+# Attach extensions
+init_default_extensions(OPENFLEXURE_EXTENSIONS_PATH)
+for extension_path in find_extension_paths(OPENFLEXURE_EXTENSIONS_PATH):
+    for extension in find_extensions_in_file(extension_path):
+        register_extension(extension)
 
 # Attach captures resources
 labthing.add_view(views.CaptureList, "/captures")
@@ -169,11 +273,13 @@ class LogFileView(View):
         """
         Most recent 1mb of log output
         """
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+        # Conditional, so a client polling an unchanged log gets a 304
         return send_file(
             ROOT_LOGFILE,
             as_attachment=True,
-            attachment_filename="openflexure_microscope_{}.log".format(timestamp),
+            attachment_filename=f"openflexure_microscope_{timestamp}.log",
+            conditional=True,
         )
 
 
@@ -182,64 +288,224 @@ labthing.add_view(LogFileView, "/log")
 @app.errorhandler(404)
 def handle_exception(err):
     err_msg = f"Error on path {err}"
-    logging.error(err_msg)
+    log.error(err_msg)
+
+# Cached body and ETag of the web app's index.html, read on first request
+_index_body: Optional[bytes] = None
+_index_etag: Optional[str] = None
+
 
 @app.route("/")
 def openflexure_ev():
-    return app.send_static_file("index.html")
+    global _index_body, _index_etag  # pylint: disable=global-statement
+    if _index_body is None:
+        try:
+            with open(os.path.join(app.static_folder, "index.html"), "rb") as f:
+                body: bytes = f.read()
+        except FileNotFoundError:
+            abort(404)
+        _index_etag = hashlib.md5(body).hexdigest()
+        _index_body = body
+    response = Response(_index_body, mimetype="text/html")
+    response.set_etag(_index_etag)
+    # Let browsers keep a copy, but revalidate it (cheaply, by ETag) each time
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route("/routes")
-@cross_origin()
 def routes():
     """
     List of all connected API routes
     """
-    return list_routes(app)
+    global _routes_cache  # pylint: disable=global-statement
+    if _routes_cache is None:
+        body: bytes = json.dumps(list_routes(app)).encode()
+        _routes_cache = (
+            body,
+            gzip.compress(body, compresslevel=9),
+            hashlib.md5(body).hexdigest(),
+        )
+    body, gzipped_body, etag = _routes_cache
+
+    if request.accept_encodings["gzip"]:
+        response = Response(gzipped_body, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        # Each encoding of the body needs its own strong ETag
+        response.set_etag(f"{etag}-gzip")
+    else:
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request)
 
 
-@app.route("/api/v1/", defaults={"path": ""})
-@app.route("/api/v1/<path:path>")
-def api_v1_catch_all(path):  # pylint: disable=W0613
-    abort(410, "API v1 is no longer in use. Please upgrade your client.")
+# Refuse requests to the old v1 API before they reach Flask
+app.wsgi_app = V1GoneMiddleware(app.wsgi_app)  # type: ignore[assignment]
 
 
 add_spec_extras(labthing.spec)
 
 
 # Automatically clean up microscope at exit
+_cleanup_done: bool = False
+
+
 def cleanup():
-    logging.debug("App teardown started...")
-    logging.debug("Settling...")
-    time.sleep(0.5)
+    global _cleanup_done  # pylint: disable=global-statement
+    if _cleanup_done:
+        return
+    _cleanup_done = True
+    log.debug("App teardown started...")
+
+    if _microscope:
+        # Don't close the capture manager while it's still being rebuilt
+        if rebuild_captures_thread:
+            rebuild_captures_thread.join(timeout=5)
 
-    # Save config
-    logging.debug("Saving config for teardown...")
-    api_microscope.save_settings()
+        # Save config
+        log.debug("Saving config for teardown...")
+        _microscope.save_settings()
 
-    logging.debug("Settling...")
-    time.sleep(0.5)
+        # Close down the microscope. Device close() calls block until they're done.
+        log.debug("Closing devices...")
+        _microscope.close()
 
-    # Close down the microscope
-    logging.debug("Closing devices...")
-    api_microscope.close()
+    log.debug("App teardown complete.")
 
-    logging.debug("Settling...")
-    time.sleep(0.5)
+    # Flush any remaining log records to disk
+    log_listener.stop()
+    access_log_listener.stop()
 
-    logging.debug("App teardown complete.")
+
+def handle_sigterm(signum, frame):  # pylint: disable=W0613
+    """Exit cleanly on SIGTERM, so that atexit handlers (and cleanup) still run"""
+    log.info("Received signal %s, shutting down...", signum)
+    sys.exit(0)
 
 
 atexit.register(cleanup)
+# SIGINT already raises KeyboardInterrupt, but the default SIGTERM action
+# (e.g. from systemd or docker stop) kills the process without running atexit.
+signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+#: Number of worker threads used to run WSGI requests under the ASGI server.
+#: The camera streams are served on the event loop, so don't occupy a worker.
+ASGI_WSGI_WORKERS: int = 32
+
+
+@contextmanager
+def mdns_registration(host: str, port: int):
+    """Advertise the microscope over mDNS for as long as the context is open
+
+    This registers the same `_labthing._tcp` service as the LabThings server.
+    """
+    from zeroconf import IPVersion, ServiceInfo, Zeroconf, get_all_addresses
+
+    service_name: str = f"{labthing.safe_title}._labthing._tcp.local."
+    if len(service_name) > 63:
+        service_name = (
+            f"{hashlib.sha1(service_name.encode()).hexdigest()}._labthing._tcp.local."
+        )
+    if host in ("", "0.0.0.0"):
+        # Advertise every external address we're listening on
+        addresses = [
+            address
+            for address in get_all_addresses()
+            if address not in ("127.0.0.1", "0.0.0.0")
+        ]
+    else:
+        addresses = [host]
+    service_info: ServiceInfo = ServiceInfo(
+        "_labthing._tcp.local.",
+        service_name,
+        port=port,
+        properties={"path": labthing.url_prefix, "id": labthing.id},
+        addresses=[socket.inet_aton(address) for address in addresses],
+    )
+    log.info("Registering zeroconf service %s", service_name)
+    zeroconf_server: Zeroconf = Zeroconf(ip_version=IPVersion.V4Only)
+    zeroconf_server.register_service(service_info)
+    try:
+        yield
+    finally:
+        log.info("Unregistering zeroconf services...")
+        zeroconf_server.unregister_service(service_info)
+        zeroconf_server.close()
+
+
+def serve_asgi(host: str = "0.0.0.0", port: int = 5000) -> bool:
+    """
+    Serve the app from an asyncio event loop using Uvicorn.
+
+    The camera streams are native ASGI endpoints (see `StreamsASGIApp`), which
+    end when their client disconnects.  The rest of the Flask app is still WSGI,
+    so its requests are dispatched to a fixed pool of worker threads by a2wsgi.
+    (asgiref's WsgiToAsgi is not used, as it runs every request on a single
+    thread.)
+
+    Returns False, without serving, if Uvicorn or a2wsgi are not installed.
+    """
+    try:
+        import uvicorn
+        from a2wsgi import WSGIMiddleware
+    except ImportError:
+        log.warning("Uvicorn is not available. Falling back to Werkzeug.")
+        return False
+
+    asgi_app: StreamsASGIApp = StreamsASGIApp(
+        WSGIMiddleware(app, workers=ASGI_WSGI_WORKERS),
+        lambda: get_microscope().camera.stream,
+    )
+
+    class StreamsServer(uvicorn.Server):
+        """Uvicorn waits for open responses on exit, so end the streams first"""
+
+        def handle_exit(self, sig, frame):
+            asgi_app.stop()
+            super().handle_exit(sig, frame)
+
+    config = uvicorn.Config(
+        asgi_app,
+        host=host,
+        port=port,
+        workers=1,
+        loop="auto",  # uvloop if installed
+        http="auto",  # httptools if installed
+        log_level=logging.getLevelName(log_level).lower(),
+    )
+    # Uvicorn configures its loggers when the config is created, so
+    # attach our access log file afterwards
+    logging.getLogger("uvicorn.access").addHandler(access_log_handler)
+    with mdns_registration(host, port):
+        StreamsServer(config).run()
+    return True
+
+
+def serve_pooled_wsgi(host: str = "0.0.0.0", port: int = 5000):
+    """Serve the app from Werkzeug, handling requests on bounded thread pools"""
+    server: PooledWSGIServer = PooledWSGIServer(host, port, app)
+    log.info("Running on http://%s:%s", host, port)
+    with mdns_registration(host, port):
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
 
 
 def ofm_serve():
-    # Start a debug server
-    from labthings import Server
+    log.info("Starting OpenFlexure Microscope Server...")
+    # Set up the hardware before accepting connections
+    get_microscope()
+    if debug_app:
+        # Start a debug server
+        from labthings import Server
 
-    logging.info("Starting OpenFlexure Microscope Server...")
-    server: Server = Server(app)
-    server.run(host="0.0.0.0", port=5000, debug=debug_app, zeroconf=True)
+        server: Server = Server(app)
+        server.run(host="0.0.0.0", port=5000, debug=debug_app, zeroconf=True)
+    elif not serve_asgi(host="0.0.0.0", port=5000):
+        serve_pooled_wsgi(host="0.0.0.0", port=5000)
 
 
 def generate_openapi():
@@ -265,14 +531,15 @@ def generate_openapi():
         if apispec.utils.validate_spec(labthing.spec):
             print("OpenAPI specification validated OK.")
     fname = args.output
+    # Build the spec dictionary once, whichever format it's written as
+    spec_dict: dict = labthing.spec.to_dict()
     if fname.endswith(".json"):
-        import json
-
         with open(fname, "w") as fd:
-            json.dump(labthing.spec.to_dict(), fd)
+            # JSONEncoder uses orjson if it's available
+            fd.write(json.dumps(spec_dict, cls=JSONEncoder))
     else:
         with open(fname, "w") as fd:
-            fd.write(labthing.spec.to_yaml())
+            fd.write(spec_to_yaml(spec_dict))
 
 
 # Start the app if the module is run directly
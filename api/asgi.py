@@ -0,0 +1,211 @@
+"""
+Native ASGI endpoints for the camera streams.
+
+Under Uvicorn the Flask app runs on a2wsgi's worker threads, which never
+close a streaming response's generator when the client goes away. An MJPEG
+client would therefore hold a worker forever once it disconnected. Here the
+stream routes are served directly on the event loop instead: one thread
+reads frames from the camera and hands them to every connected client, and
+each stream ends as soon as its client disconnects or the server stops.
+"""
+import asyncio
+import logging
+import threading
+from typing import AsyncIterator, Callable, Optional
+
+from openflexure_microscope.camera.base import FrameStream
+
+#: Paths (under the API prefix) of the streams served natively
+MJPEG_STREAM_PATH: str = "/api/v2/streams/mjpeg"
+SNAPSHOT_STREAM_PATH: str = "/api/v2/streams/snapshot"
+
+MJPEG_CONTENT_TYPE: bytes = b"multipart/x-mixed-replace; boundary=frame"
+MJPEG_FRAME_HEADER: bytes = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+
+# LabThings allows any origin for everything under /api/v2
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+class FrameBroadcaster:
+    """
+    Share the camera stream's frames with any number of asyncio clients.
+
+    A single daemon thread waits for new frames (as `FrameStream.getframe`
+    blocks), for as long as any client is listening, and publishes each one
+    on the event loop.
+    """
+
+    def __init__(self, get_stream: Callable[[], FrameStream]):
+        self._get_stream = get_stream
+        self._lock: threading.Lock = threading.Lock()
+        self._stopped: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._clients: int = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._frame: Optional[bytes] = None
+        self._new_frame: Optional[asyncio.Event] = None
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+
+    def stop(self):
+        """Stop reading frames, and end every client's stream"""
+        self._stopped.set()
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._publish, None)
+
+    async def frames(self) -> AsyncIterator[bytes]:
+        """Yield each new frame from the camera, until the broadcaster stops"""
+        self._subscribe()
+        try:
+            while not self.stopped:
+                new_frame: asyncio.Event = self._new_frame
+                await new_frame.wait()
+                if self.stopped:
+                    return
+                yield self._frame
+        finally:
+            self._unsubscribe()
+
+    async def next_frame(self) -> Optional[bytes]:
+        """Wait for the next frame, or return None if the broadcaster stops"""
+        frames = self.frames()
+        try:
+            return await frames.__anext__()
+        except StopAsyncIteration:
+            return None
+        finally:
+            await frames.aclose()
+
+    def _subscribe(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._new_frame = asyncio.Event()
+        with self._lock:
+            self._clients += 1
+            if self._thread is None and not self.stopped:
+                self._thread = threading.Thread(
+                    target=self._read_frames, name="FrameBroadcaster", daemon=True
+                )
+                self._thread.start()
+
+    def _unsubscribe(self):
+        with self._lock:
+            self._clients -= 1
+
+    def _read_frames(self):
+        """Read frames from the camera for as long as anyone is listening"""
+        while True:
+            with self._lock:
+                if self._clients == 0 or self.stopped:
+                    self._thread = None
+                    return
+            try:
+                frame: bytes = self._get_stream().getframe()
+            except Exception:  # pylint: disable=W0703
+                logging.exception("Unable to read a frame from the camera stream")
+                self._stopped.wait(1)
+                continue
+            try:
+                self._loop.call_soon_threadsafe(self._publish, frame)
+            except RuntimeError:  # The event loop has been closed
+                with self._lock:
+                    self._thread = None
+                return
+
+    def _publish(self, frame: Optional[bytes]):
+        """Wake every waiting client (runs on the event loop)"""
+        if frame is not None:
+            self._frame = frame
+        new_frame: asyncio.Event = self._new_frame
+        self._new_frame = asyncio.Event()
+        new_frame.set()
+
+
+async def _cancel_on_disconnect(receive, task: asyncio.Task):
+    """Cancel a response's task once its client has disconnected"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    task.cancel()
+
+
+class StreamsASGIApp:
+    """
+    ASGI app serving the camera streams natively, and everything else from ``app``.
+
+    ``app`` is usually the Flask app, wrapped by a2wsgi's ``WSGIMiddleware``.
+    """
+
+    def __init__(self, app, get_stream: Callable[[], FrameStream]):
+        self.app = app
+        self.broadcaster: FrameBroadcaster = FrameBroadcaster(get_stream)
+
+    def stop(self):
+        """End all open streams, e.g. so that the server can shut down"""
+        self.broadcaster.stop()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            path: str = scope["path"].rstrip("/")
+            if path == MJPEG_STREAM_PATH:
+                return await self.mjpeg_stream(scope, receive, send)
+            if path == SNAPSHOT_STREAM_PATH:
+                return await self.snapshot(scope, receive, send)
+        return await self.app(scope, receive, send)
+
+    async def mjpeg_stream(self, scope, receive, send):
+        """Real-time MJPEG stream from the microscope camera"""
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", MJPEG_CONTENT_TYPE)] + CORS_HEADERS,
+            }
+        )
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+        watcher = asyncio.ensure_future(
+            _cancel_on_disconnect(receive, asyncio.current_task())
+        )
+        try:
+            async for frame in self.broadcaster.frames():
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": MJPEG_FRAME_HEADER + frame + b"\r\n",
+                        "more_body": True,
+                    }
+                )
+            # The server is stopping, so end the response
+            await send({"type": "http.response.body", "body": b""})
+        except asyncio.CancelledError:
+            if not watcher.done():
+                raise
+            # Otherwise, the client has gone, and there's no one to reply to
+        finally:
+            watcher.cancel()
+
+    async def snapshot(self, scope, receive, send):  # pylint: disable=W0613
+        """Single JPEG snapshot from the camera stream"""
+        frame: Optional[bytes] = await self.broadcaster.next_frame()
+        if frame is None:
+            status, content_type, body = 503, b"text/plain", b"Server is stopping"
+        else:
+            status, content_type, body = 200, b"image/jpeg", frame
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type),
+                    (b"content-length", str(len(body)).encode()),
+                ]
+                + CORS_HEADERS,
+            }
+        )
+        if scope["method"] == "HEAD":
+            body = b""
+        await send({"type": "http.response.body", "body": body})
@@ -1,11 +1,28 @@
+import importlib
 import logging
+import threading
 import traceback
 from contextlib import contextmanager
-from typing import List, Type
+from typing import List, Optional, Tuple, Type
 
 from labthings.extensions import BaseExtension
 
-LABTHINGS_EXTENSIONS: List[Type[BaseExtension]] = []
+# Listed explicitly, as LABTHINGS_EXTENSIONS is created lazily by __getattr__
+# and so would otherwise be missed by `from ... import *`
+__all__ = ["LABTHINGS_EXTENSIONS"]
+
+#: Builtin extensions, as (name, module, class name), in the order they are loaded
+EXTENSION_SPECS: List[Tuple[str, str, str]] = [
+    ("autofocus", ".autofocus", "AutofocusExtension"),
+    ("scan", ".scan", "ScanExtension"),
+    ("zip builder", ".zip_builder", "ZipBuilderExtension"),
+    ("autostorage", ".autostorage", "AutostorageExtension"),
+    ("lens shading calibration", ".picamera_autocalibrate", "LSTExtension"),
+    ("camera stage mapping", ".camera_stage_mapping", "CSMExtension"),
+]
+
+_extensions: Optional[List[Type[BaseExtension]]] = None
+_extensions_lock: threading.Lock = threading.Lock()
 
 
 @contextmanager
@@ -21,29 +38,29 @@ def handle_extension_error(extension_name):
         )
 
 
-with handle_extension_error("autofocus"):
-    from .autofocus import AutofocusExtension
-
-    LABTHINGS_EXTENSIONS.append(AutofocusExtension)
-with handle_extension_error("scan"):
-    from .scan import ScanExtension
-
-    LABTHINGS_EXTENSIONS.append(ScanExtension)
-with handle_extension_error("zip builder"):
-    from .zip_builder import ZipBuilderExtension
-
-    LABTHINGS_EXTENSIONS.append(ZipBuilderExtension)
-with handle_extension_error("autostorage"):
-    from .autostorage import AutostorageExtension
-
-    LABTHINGS_EXTENSIONS.append(AutostorageExtension)
-
-with handle_extension_error("lens shading calibration"):
-    from .picamera_autocalibrate import LSTExtension
+def load_extension(spec: Tuple[str, str, str]) -> Optional[Type[BaseExtension]]:
+    """Import a builtin extension class, returning None if it fails to load."""
+    extension_name, module_name, class_name = spec
+    with handle_extension_error(extension_name):
+        module = importlib.import_module(module_name, __name__)
+        return getattr(module, class_name)
+    return None
 
-    LABTHINGS_EXTENSIONS.append(LSTExtension)
 
-with handle_extension_error("camera stage mapping"):
-    from .camera_stage_mapping import CSMExtension
+def __getattr__(name: str):
+    """Import the builtin extensions the first time they are requested.
 
-    LABTHINGS_EXTENSIONS.append(CSMExtension)
+    Importing the extensions pulls in heavy dependencies (numpy, scipy,
+    picamera...), so we only do it when `LABTHINGS_EXTENSIONS` is accessed.
+    The extensions share many of those imports, so they are imported one at
+    a time, in the order of `EXTENSION_SPECS`, so that the same extensions
+    load every time.
+    """
+    global _extensions  # pylint: disable=global-statement
+    if name != "LABTHINGS_EXTENSIONS":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _extensions_lock:
+        if _extensions is None:
+            loaded = [load_extension(spec) for spec in EXTENSION_SPECS]
+            _extensions = [extension for extension in loaded if extension]
+    return _extensions
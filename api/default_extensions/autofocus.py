@@ -5,11 +5,23 @@ from contextlib import contextmanager
 from typing import Callable, Dict, List, Optional, Tuple, cast
 
 import numpy as np
+
+try:
+    # OpenCV's filters are NEON-accelerated on the Pi, but it's not a hard dependency
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    # Numba compiles the sharpness metrics to fused, multi-core loops, which
+    # release the GIL so the MJPEG stream keeps running while they evaluate
+    import numba
+except ImportError:
+    numba = None
 from labthings import current_action, fields, find_component
 from labthings.extensions import BaseExtension
 from labthings.utilities import get_docstring, get_summary
 from labthings.views import ActionView, View
-from scipy import ndimage
 
 from openflexure_microscope.camera.base import BaseCamera
 from openflexure_microscope.devel import abort
@@ -20,6 +32,61 @@ from openflexure_microscope.utilities import set_properties
 ### Autofocus utilities
 
 
+def interpolate_z(
+    times: np.ndarray, stage_times: np.ndarray, stage_zs: np.ndarray
+) -> np.ndarray:
+    """Estimate the stage's z position at each time, by linear interpolation
+
+    This is equivalent to `np.interp(times, stage_times, stage_zs)`, but a
+    single move (i.e. two stage points) is done with a straight linear map.
+    """
+    if len(stage_times) != 2:
+        return np.interp(times, stage_times, stage_zs)
+    t0, t1 = stage_times
+    z0, z1 = stage_zs
+    if t1 == t0:
+        # As np.interp: the start position before the move, the end from then on
+        return np.where(np.asarray(times) < t0, z0, z1).astype(np.float64)
+    slope: float = (z1 - z0) / (t1 - t0)
+    # Clip, as np.interp clamps times outside the move to its end points
+    return z0 + (np.clip(times, t0, t1) - t0) * slope
+
+
+class _GrowableArray:
+    """A NumPy array that can be appended to in amortised O(1) time
+
+    Rows are stored in a preallocated buffer, whose capacity doubles when it's
+    full.  `data` is a view (not a copy) of the rows added so far.
+    """
+
+    def __init__(self, dtype, row_shape: Tuple[int, ...] = (), capacity: int = 256):
+        self._buffer: np.ndarray = np.empty((capacity,) + row_shape, dtype=dtype)
+        self._n: int = 0
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._buffer[: self._n]
+
+    def extend(self, rows) -> None:
+        rows = np.asarray(rows, dtype=self._buffer.dtype)
+        needed: int = self._n + len(rows)
+        if needed > len(self._buffer):
+            capacity: int = max(needed, 2 * len(self._buffer))
+            buffer: np.ndarray = np.empty(
+                (capacity,) + self._buffer.shape[1:], dtype=self._buffer.dtype
+            )
+            buffer[: self._n] = self.data
+            self._buffer = buffer
+        self._buffer[self._n : needed] = rows
+        self._n = needed
+
+    def append(self, row) -> None:
+        self.extend([row])
+
+
 class JPEGSharpnessMonitor:
     """Monitor JPEG frame size in a background thread
     
@@ -32,10 +99,41 @@ class JPEGSharpnessMonitor:
 
         self.recording_start_time: Optional[float] = None
 
-        self.stage_positions: List[Tuple[int, int, int]] = []
-        self.stage_times: List[float] = []
-        self.jpeg_times: List[float] = []
-        self.jpeg_sizes: List[int] = []
+        # Recorded data is kept in growable arrays, stored column-wise
+        self._stage_positions: _GrowableArray = _GrowableArray(np.int64, (3,))
+        self._stage_times: _GrowableArray = _GrowableArray(np.float64)
+        self._jpeg_times: _GrowableArray = _GrowableArray(np.float64)
+        self._jpeg_sizes: _GrowableArray = _GrowableArray(np.int64)
+
+    @property
+    def stage_positions(self) -> np.ndarray:
+        """(x, y, z) stage position at the start and end of each move, as (N, 3)"""
+        return self._stage_positions.data
+
+    @property
+    def stage_times(self) -> np.ndarray:
+        """Times of each entry in `stage_positions`"""
+        return self._stage_times.data
+
+    @property
+    def jpeg_times(self) -> np.ndarray:
+        """Times of each recorded JPEG frame (a view, not a copy)"""
+        return self._jpeg_times.data
+
+    @property
+    def jpeg_sizes(self) -> np.ndarray:
+        """Sizes of each recorded JPEG frame (a view, not a copy)"""
+        return self._jpeg_sizes.data
+
+    def _record_stage(self, position) -> None:
+        """Record the current time and a stage position"""
+        self._stage_times.append(time.time())
+        self._stage_positions.append(position)
+
+    def _record_frames(self, times: np.ndarray, sizes: np.ndarray) -> None:
+        """Append arrays of frame times and sizes to our arrays"""
+        self._jpeg_times.extend(times)
+        self._jpeg_sizes.extend(sizes)
 
     def start(self):
         # Log the recording start time
@@ -48,106 +146,108 @@ class JPEGSharpnessMonitor:
     def hold(self, delay: int = 5):
         """Run time.sleep for delay seconds, 
         while monitoring the JPEG frame size of the stream"""
+        # The stage doesn't move while we hold, so only read its position once
+        position: Tuple[int, int, int] = self.stage.position
         self.camera.stream.start_tracking()
-        self.stage_times.append(time.time())
-        self.stage_positions.append(self.stage.position)
+        self._record_stage(position)
 
         time.sleep(delay)
 
         self.camera.stream.stop_tracking()
-        self.stage_times.append(time.time())
-        self.stage_positions.append(self.stage.position)
+        self._record_stage(position)
 
         # Retrieve frame data
-        for frame in self.camera.stream.frames:
-            # Make timestamp absolute Unix time
-            self.jpeg_times.append(frame.time)
-            self.jpeg_sizes.append(frame.size)
+        self._record_frames(*self.camera.stream.tracked_arrays())
         # Clear frame data for this move from the stream
         self.camera.stream.reset_tracking()
 
         # Index of the data for this movement
         data_index: int = len(self.stage_positions) - 2
         # Final z position after move
-        final_z_position: int = self.stage_positions[-1][2]
+        final_z_position: int = int(self.stage_positions[-1, 2])
         return data_index, final_z_position
 
     def focus_rel(self, dz: int, backlash: bool = False, **kwargs) -> Tuple[int, int]:
         # Store the start time and position
         self.camera.stream.start_tracking()
-        self.stage_times.append(time.time())
-        self.stage_positions.append(self.stage.position)
+        self._record_stage(self.stage.position)
 
         # Main move
         self.stage.move_rel((0, 0, dz), backlash=backlash, **kwargs)
 
         # Store the end time and position
         self.camera.stream.stop_tracking()
-        self.stage_times.append(time.time())
-        self.stage_positions.append(self.stage.position)
+        self._record_stage(self.stage.position)
 
         # Retrieve frame data
-        for frame in self.camera.stream.frames:
-            # Make timestamp absolute Unix time
-            self.jpeg_times.append(frame.time)
-            self.jpeg_sizes.append(frame.size)
+        self._record_frames(*self.camera.stream.tracked_arrays())
         # Clear frame data for this move from the stream
         self.camera.stream.reset_tracking()
 
         # Index of the data for this movement
         data_index: int = len(self.stage_positions) - 2
         # Final z position after move
-        final_z_position: int = self.stage_positions[-1][2]
+        final_z_position: int = int(self.stage_positions[-1, 2])
         return data_index, final_z_position
 
+    def _move_frame_range(self, istart: int, istop: int) -> Tuple[int, int]:
+        """Return the slice of recorded frames that belong to a move"""
+        jpeg_times: np.ndarray = self.jpeg_times
+        stage_times: np.ndarray = self.stage_times[istart:istop]
+        # Frames are recorded in order, so jpeg_times is sorted and we can
+        # binary search for the first frame after the start/end of the move
+        start: int = int(np.searchsorted(jpeg_times, stage_times[0], side="right"))
+        stop: int = int(np.searchsorted(jpeg_times, stage_times[1], side="right"))
+        if start == len(jpeg_times):
+            raise ValueError(
+                "No images were captured during the move of the stage.  Perhaps the camera is not streaming images?"
+            )
+        if stop == 0:
+            stop = len(jpeg_times)
+            logging.debug("changing stop to %s", (stop))
+        return start, stop
+
     def move_data(
         self, istart: int, istop: Optional[int] = None
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """Extract sharpness as a function of (interpolated) z"""
         if istop is None:
             istop = istart + 2
-        jpeg_times: np.ndarray = np.array(self.jpeg_times)  # np.ndarray[float]
-        jpeg_sizes: np.ndarray = np.array(self.jpeg_sizes)  # np.ndarray[int]
-        stage_times: np.ndarray = np.array(self.stage_times)[
-            istart:istop
-        ]  # np.ndarray[float]
-        stage_zs: np.ndarray = np.array(self.stage_positions)[
-            istart:istop, 2
-        ]  # np.ndarray[int]
-        try:
-            start: int = int(np.argmax(jpeg_times > stage_times[0]))
-            stop: int = int(np.argmax(jpeg_times > stage_times[1]))
-        except ValueError as e:
-            if np.sum(jpeg_times > stage_times[0]) == 0:
-                raise ValueError(
-                    "No images were captured during the move of the stage.  Perhaps the camera is not streaming images?"
-                ) from e
-            else:
-                raise e
-        if stop < 1:
-            stop = len(jpeg_times)
-            logging.debug("changing stop to %s", (stop))
-        jpeg_times = jpeg_times[start:stop]
-        jpeg_zs: np.ndarray = np.interp(
-            jpeg_times, stage_times, stage_zs
+        start, stop = self._move_frame_range(istart, istop)
+        jpeg_times: np.ndarray = self.jpeg_times[start:stop]  # np.ndarray[float]
+        jpeg_zs: np.ndarray = interpolate_z(
+            jpeg_times,
+            self.stage_times[istart:istop],
+            self.stage_positions[istart:istop, 2],
         )  # np.ndarray[float]
-        return jpeg_times, jpeg_zs, jpeg_sizes[start:stop]
+        return jpeg_times, jpeg_zs, self.jpeg_sizes[start:stop]
 
     def sharpest_z_on_move(self, index: int) -> int:
         """Return the z position of the sharpest image on a given move"""
-        _, jz, js = self.move_data(index)
-        if len(js) == 0:
+        start, stop = self._move_frame_range(index, index + 2)
+        if stop <= start:
             raise ValueError(
                 "No images were captured during the move of the stage.  Perhaps the camera is not streaming images?"
             )
-        return jz[np.argmax(js)]
+        # Only interpolate z for the sharpest frame, not every frame in the move
+        sharpest: int = start + int(np.argmax(self.jpeg_sizes[start:stop]))
+        return interpolate_z(
+            self.jpeg_times[sharpest : sharpest + 1],
+            self.stage_times[index : index + 2],
+            self.stage_positions[index : index + 2, 2],
+        )[0]
 
     def data_dict(self) -> Dict[str, np.ndarray]:
-        """Return the gathered data as a single convenient dictionary"""
-        data = {}
-        for k in ["jpeg_times", "jpeg_sizes", "stage_times", "stage_positions"]:
-            data[k] = getattr(self, k)
-        return data
+        """Return the gathered data as a single convenient dictionary
+
+        The values are views of the recorded arrays, so nothing is copied.
+        """
+        return {
+            "jpeg_times": self._jpeg_times.data,
+            "jpeg_sizes": self._jpeg_sizes.data,
+            "stage_times": self._stage_times.data,
+            "stage_positions": self._stage_positions.data,
+        }
 
 
 @contextmanager
@@ -160,21 +260,175 @@ def monitor_sharpness(microscope: Microscope):
         m.stop()
 
 
+if numba is not None:
+
+    @numba.njit(nogil=True, cache=True)
+    def _reflect_index(i: int, length: int) -> int:
+        """Index into a symmetrically reflected axis (as ndimage's "reflect")"""
+        i = i % (2 * length)
+        return i if i < length else 2 * length - i - 1
+
+    @numba.njit(nogil=True, parallel=True, cache=True)
+    def _green_laplacian_variance(rgb_image: np.ndarray) -> float:
+        """Variance of the green channel's Laplacian, over the image interior"""
+        height, width = rgb_image.shape[0], rgb_image.shape[1]
+        total = 0
+        total_sq = 0
+        for i in numba.prange(1, height - 1):
+            for j in range(1, width - 1):
+                lap = (
+                    4 * np.int64(rgb_image[i, j, 1])
+                    - np.int64(rgb_image[i - 1, j, 1])
+                    - np.int64(rgb_image[i + 1, j, 1])
+                    - np.int64(rgb_image[i, j - 1, 1])
+                    - np.int64(rgb_image[i, j + 1, 1])
+                )
+                total += lap
+                total_sq += lap * lap
+        n = (height - 2) * (width - 2)
+        return total_sq / n - (total / n) ** 2
+
+    @numba.njit(nogil=True, inline="always")
+    def _channel_sum(rgb_image: np.ndarray, i: int, j: int) -> int:
+        """Sum of the colour channels of one pixel"""
+        return (
+            np.int64(rgb_image[i, j, 0])
+            + np.int64(rgb_image[i, j, 1])
+            + np.int64(rgb_image[i, j, 2])
+        )
+
+    @numba.njit(nogil=True, parallel=True, cache=True)
+    def _edge_sum_squares(rgb_image: np.ndarray, n: int) -> float:
+        """Sum of squared box-edge responses along both axes of the channel sum
+
+        Channel sums are read straight from the image as they are needed, so
+        no grayscale copy of the image is allocated.
+        """
+        height, width = rgb_image.shape[0], rgb_image.shape[1]
+        total = 0
+        # Rows: prefix sums over the reflected row, then 3 lookups per pixel
+        for i in numba.prange(height):
+            csum = np.zeros(width + 2 * n + 1, dtype=np.int64)
+            for k in range(width + 2 * n):
+                csum[k + 1] = csum[k] + _channel_sum(
+                    rgb_image, i, _reflect_index(k - n, width)
+                )
+            for j in range(width):
+                response = 2 * csum[j + n + 1] - csum[j + 1] - csum[j + 2 * n + 1]
+                total += response * response
+        # Columns, likewise
+        for j in numba.prange(width):
+            csum = np.zeros(height + 2 * n + 1, dtype=np.int64)
+            for k in range(height + 2 * n):
+                csum[k + 1] = csum[k] + _channel_sum(
+                    rgb_image, _reflect_index(k - n, height), j
+                )
+            for i in range(height):
+                response = 2 * csum[i + n + 1] - csum[i + 1] - csum[i + 2 * n + 1]
+                total += response * response
+        return total / 3 ** 2
+
+
 def sharpness_sum_lap2(rgb_image: np.ndarray) -> float:
-    """Return an image sharpness metric: sum(laplacian(image)**")"""
-    image_bw = np.mean(rgb_image, 2)
-    image_lap = ndimage.filters.laplace(image_bw)
-    return float(np.mean(image_lap.astype(float) ** 4))
+    """Return an image sharpness metric: the variance of the image's Laplacian
+
+    Only the green channel is used, which carries most of the luminance
+    information.  The Laplacian is calculated with integer arithmetic in a
+    single pass over the image interior.
+
+    NB this used to be mean(laplacian(image)**4) over all channels (hence
+    the name).  Sharpness values are on a different scale to that metric,
+    but are still only meaningful relative to one another.
+    """
+    if numba is not None:
+        return _green_laplacian_variance(rgb_image)
+    if cv2 is not None:
+        green_u8: np.ndarray = np.ascontiguousarray(rgb_image[:, :, 1])
+        # ksize=1 is the same 4-neighbour stencil (negated, which var ignores)
+        lap_cv: np.ndarray = cv2.Laplacian(green_u8, cv2.CV_16S, ksize=1)
+        _, stddev = cv2.meanStdDev(lap_cv[1:-1, 1:-1])
+        return float(stddev[0, 0] ** 2)
+
+    # A signed copy of the green channel; its Laplacian (at most 4*255) fits in int16
+    green: np.ndarray = rgb_image[:, :, 1].astype(np.int16)
+    lap: np.ndarray = (
+        4 * green[1:-1, 1:-1]
+        - green[:-2, 1:-1]
+        - green[2:, 1:-1]
+        - green[1:-1, :-2]
+        - green[1:-1, 2:]
+    )
+    # var = E[lap**2] - E[lap]**2, with both sums done in (exact) int64
+    n: int = lap.size
+    lap_sum: int = int(lap.sum(dtype=np.int64))
+    lap2_sum: int = int(np.einsum("ij,ij->", lap, lap, dtype=np.int64))
+    return lap2_sum / n - (lap_sum / n) ** 2
+
+
+def _box_edge_response(gray: np.ndarray, n: int, axis: int) -> np.ndarray:
+    """Convolve with an edge kernel, ``[-1] * n + [1] * n``, along one axis
+
+    The kernel is the difference of two length-n boxcars, so each output is
+    found from three lookups in a cumulative sum, rather than 2n multiply-adds.
+    Edges are reflected, as in `scipy.ndimage.convolve`, which this matches.
+    """
+    pad_width = [(0, 0)] * gray.ndim
+    pad_width[axis] = (n, n)
+    padded: np.ndarray = np.pad(gray, pad_width, mode="symmetric")
+    csum: np.ndarray = np.cumsum(padded, axis=axis)
+    # Prepend a zero, so that csum[i] is the sum of the first i padded values
+    zero_shape = list(csum.shape)
+    zero_shape[axis] = 1
+    csum = np.concatenate([np.zeros(zero_shape, dtype=csum.dtype), csum], axis=axis)
+
+    length: int = gray.shape[axis]
+
+    def window(start: int) -> np.ndarray:
+        index = [slice(None)] * gray.ndim
+        index[axis] = slice(start, start + length)
+        return csum[tuple(index)]
+
+    # sum(gray[j - n + 1 : j + 1]) - sum(gray[j + 1 : j + n + 1])
+    return 2 * window(n + 1) - window(1) - window(2 * n + 1)
+
+
+#: Half-width of the edge kernel used by `sharpness_edge`
+EDGE_KERNEL_N: int = 20
+# The edge kernel ([-1] * n + [1] * n) and its transpose, for OpenCV
+_EDGE_KERNEL: np.ndarray = np.array(
+    [[-1] * EDGE_KERNEL_N + [1] * EDGE_KERNEL_N], dtype=np.float32
+)
+_EDGE_KERNEL_T: np.ndarray = np.ascontiguousarray(_EDGE_KERNEL.T)
 
 
 def sharpness_edge(image: np.ndarray) -> float:
     """Return a sharpness metric optimised for vertical lines"""
-    gray = np.mean(image.astype(float), 2)
-    n: int = 20
-    edge: np.ndarray = np.array([[-1] * n + [1] * n])
-    return float(
-        np.sum([np.sum(ndimage.filters.convolve(gray, W) ** 2) for W in [edge, edge.T]])
-    )
+    n: int = EDGE_KERNEL_N
+    if numba is not None:
+        return _edge_sum_squares(rgb_image=image, n=n)
+    if cv2 is not None:
+        gray_f: np.ndarray = image.sum(axis=2, dtype=np.float32) / 3
+        total_cv: float = 0.0
+        # Anchors and border mode chosen to match ndimage.convolve
+        for kernel, anchor in (
+            (_EDGE_KERNEL, (n - 1, 0)),
+            (_EDGE_KERNEL_T, (0, n - 1)),
+        ):
+            response_cv: np.ndarray = cv2.filter2D(
+                gray_f, cv2.CV_32F, kernel, anchor=anchor, borderType=cv2.BORDER_REFLECT
+            )
+            total_cv += np.einsum("ij,ij->", response_cv, response_cv, dtype=np.float64)
+        return float(total_cv)
+
+    # Work on the (exact, integer) channel sum, and divide by 3**2 at the end.
+    # Its running sums and edge responses fit comfortably in int32, which
+    # halves the memory traffic; the squares are summed in int64.
+    gray: np.ndarray = image.sum(axis=2, dtype=np.int32)
+    total: int = 0
+    for axis in (1, 0):
+        response: np.ndarray = _box_edge_response(gray, n, axis)
+        total += int(np.einsum("ij,ij->", response, response, dtype=np.int64))
+    return total / 3 ** 2
 
 
 def find_microscope() -> Microscope:
@@ -327,19 +581,25 @@ class AutofocusExtension(BaseExtension):
         self,
         microscope: Optional[Microscope] = None,
         metric_fn: Callable = sharpness_sum_lap2,
+        downsample: int = 2,
     ) -> float:
         """Measure the sharpness from the MJPEG stream
         
         Take a JPEG snapshot from the camera (extracted from the live preview stream)
         and return its size.  This is the sharpness metric used by the fast autofocus
         method.
+
+        The image is subsampled by `downsample` in each direction (a strided view,
+        not a copy) before `metric_fn` is applied, which is plenty for ranking
+        sharpness.  Only compare values measured with the same `downsample`.
         """
         if not microscope:
             microscope = find_microscope()
         if hasattr(microscope.camera, "array") and callable(
             getattr(microscope.camera, "array")
         ):
-            return metric_fn(getattr(microscope.camera, "array")(use_video_port=True))
+            image: np.ndarray = getattr(microscope.camera, "array")(use_video_port=True)
+            return metric_fn(image[::downsample, ::downsample])
         else:
             raise RuntimeError(f"Object {microscope.camera} has no method `array`")
 
@@ -358,6 +618,8 @@ class AutofocusExtension(BaseExtension):
         dz: Optional[List[int]] = None,
         settle: float = 0.5,
         metric_fn: Callable = sharpness_sum_lap2,
+        downsample: int = 2,
+        early_stop: bool = False,
     ) -> Tuple[List[int], List[float]]:
         """Perform a simple autofocus routine.
 
@@ -367,6 +629,13 @@ class AutofocusExtension(BaseExtension):
         highest.  No interpolation is performed.
 
         dz is assumed to be in ascending order (starting at -ve values)
+
+        Images are subsampled by `downsample` before measuring sharpness (see
+        `measure_sharpness`).
+
+        If `early_stop` is set, the sweep ends once the last two positions are
+        both well below (< 70% of) the sharpest so far, as focus is then clearly
+        behind us.  The returned lists only cover the positions visited.
         """
         if not microscope:
             microscope = find_microscope_with_real_stage()
@@ -384,12 +653,23 @@ class AutofocusExtension(BaseExtension):
             if getattr(camera, "annotate_text", None):
                 setattr(camera, "annotate_text", "")
 
+            # The action (if any) runs in this thread, so look it up only once
+            action = current_action()
+            measure_sharpness = self.measure_sharpness
+
             for _ in stage.scan_z(dz, return_to_start=False):
-                if current_action() and current_action().stopped:
+                if action and action.stopped:
                     return [], []
                 positions.append(stage.position[2])
                 time.sleep(settle)
-                sharpnesses.append(self.measure_sharpness(microscope, metric_fn))
+                sharpnesses.append(measure_sharpness(microscope, metric_fn, downsample))
+                if (
+                    early_stop
+                    and len(sharpnesses) >= 3
+                    and max(sharpnesses[-2:]) < 0.7 * max(sharpnesses)
+                ):
+                    logging.debug("Sharpness has peaked, stopping autofocus sweep")
+                    break
 
             newposition: int = positions[int(np.argmax(sharpnesses))]
             stage.move_rel((0, 0, newposition - stage.position[2]))
@@ -661,7 +941,7 @@ class AutofocusExtension(BaseExtension):
 
                 # We've deliberately undershot - figure out how much further we should move based on the curve
                 logging.debug("Calculate remining movement")
-                current_js = m.camera.stream.last.size
+                current_js: int = m.camera.stream.last.size
                 imax: int = int(
                     np.argmax(js)
                 )  # we want to crop out just the bit below the peak
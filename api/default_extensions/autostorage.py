@@ -1,10 +1,11 @@
 import logging
 import os
-from typing import Dict, List, Optional, Tuple
+import re
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
-import psutil
 from flask import abort
-from labthings import fields, find_component
+from labthings import fields
 from labthings.extensions import BaseExtension
 from labthings.marshalling import use_args
 from labthings.views import PropertyView, View
@@ -15,23 +16,89 @@ from openflexure_microscope.captures.capture_manager import (
     CaptureManager,
 )
 from openflexure_microscope.microscope import Microscope
-from openflexure_microscope.paths import check_rw, settings_file_path
+from openflexure_microscope.paths import check_rw_dir, settings_file_path
 
 AS_SETTINGS_PATH = settings_file_path("autostorage_settings.json")
 
+#: Seconds to reuse the list of available storage locations for
+LOCATIONS_CACHE_TTL: float = 2.0
+#: Seconds to reuse the result of checking a directory is writeable for
+RW_CACHE_TTL: float = 5.0
+
+#: Linux's table of mounted filesystems, and of filesystem types
+PROC_MOUNTS_PATH = "/proc/self/mounts"
+PROC_FILESYSTEMS_PATH = "/proc/filesystems"
+
+# Spaces etc. in mount points are written as octal escapes, e.g. "\\040"
+_MOUNT_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def get_proc_partitions() -> List[str]:
+    """List writeable physical partitions by reading /proc directly
+
+    This matches `psutil.disk_partitions()`, but avoids the `statfs` call it
+    makes on every mount, which can block for seconds on stale network mounts.
+    Raises OSError if /proc isn't available (i.e. we're not on Linux).
+    """
+    with open(PROC_FILESYSTEMS_PATH) as f:
+        # Virtual filesystems (proc, tmpfs...) are flagged "nodev"
+        physical_fstypes = {
+            line.split()[0]
+            for line in f
+            if line.strip() and not line.startswith("nodev")
+        }
+    partitions: List[str] = []
+    with open(PROC_MOUNTS_PATH) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+            device, mountpoint, fstype, opts = parts[:4]
+            if device == "none" or fstype not in physical_fstypes:
+                continue
+            if "rw" in opts.split(","):
+                partitions.append(
+                    _MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), mountpoint)
+                )
+    return partitions
+
+
+def get_mounts_table() -> Optional[str]:
+    """Return the mount table, or None if /proc isn't available
+
+    It's cheap to read, so is used to tell when drives are (un)mounted.
+    """
+    try:
+        with open(PROC_MOUNTS_PATH) as f:
+            return f.read()
+    except OSError:
+        return None
+
 
 def get_partitions() -> List[str]:
-    return [disk.mountpoint for disk in psutil.disk_partitions() if "rw" in disk.opts]
+    try:
+        return get_proc_partitions()
+    except OSError:
+        # Only import psutil where /proc isn't available, to save startup time
+        import psutil  # pylint: disable=C0415
+
+        return [
+            disk.mountpoint for disk in psutil.disk_partitions() if "rw" in disk.opts
+        ]
 
 
-def get_permissive_partitions() -> List[str]:
+def get_permissive_partitions(
+    check_rw: Callable[[str], bool] = check_rw_dir
+) -> List[str]:
     return [partition for partition in get_partitions() if check_rw(partition)]
 
 
-def get_permissive_locations() -> List[Tuple[str, str]]:
+def get_permissive_locations(
+    check_rw: Callable[[str], bool] = check_rw_dir
+) -> List[Tuple[str, str]]:
     return [
         (partition, os.path.join(partition, "openflexure", "data", "micrographs"))
-        for partition in get_permissive_partitions()
+        for partition in get_permissive_partitions(check_rw)
     ]
 
 
@@ -47,8 +114,11 @@ def set_current_location(capture_manager: Optional[CaptureManager], location: st
             "Cannot set_current_location of a missing capture_manager. Skipping."
         )
         return
-    if not os.path.isdir(location):
-        os.makedirs(location)
+    os.makedirs(location, exist_ok=True)
+    if capture_manager.paths.get("default") == location:
+        # Nothing has changed, so there's no need to rebuild the captures
+        logging.debug("Capture location is already %s.", location)
+        return
     logging.debug("Updating location...")
     capture_manager.paths.update({"default": location})
     logging.debug("Rebuilding captures...")
@@ -60,24 +130,22 @@ def get_default_location() -> str:
     return BASE_CAPTURE_PATH
 
 
-def get_all_locations() -> Dict[str, str]:
+def get_all_locations(check_rw: Callable[[str], bool] = check_rw_dir) -> Dict[str, str]:
     locations: Dict[str, str] = {}
     # If default is not already listed (e.g. if it's currently set)
     if get_default_location() not in locations.values():
         locations["Default"] = get_default_location()
 
-    for ppartition, plocation in get_permissive_locations():
+    # Drives of the locations found so far
+    drives = {os.path.splitdrive(location)[0] for location in locations.values()}
+    for ppartition, plocation in get_permissive_locations(check_rw):
         pdrive = os.path.splitdrive(plocation)[0]
         if not (
             pdrive  # If path actually has a drive (basically just Windows?)
-            and any(  # And shares a common drive with an existing location
-                [
-                    pdrive == os.path.splitdrive(location)[0]
-                    for location in locations.values()
-                ]
-            )
+            and pdrive in drives  # And shares a common drive with an existing location
         ):
             locations[ppartition] = plocation
+            drives.add(pdrive)
 
     # Strip out Nones
     return {k: v for k, v in locations.items() if v}
@@ -91,9 +159,18 @@ class AutostorageExtension(BaseExtension):
             description="Handle switching capture storage devices",
         )
 
-        # We'll store a reference to a CaptureManager object, who's capture paths will be modified
+        # We'll store a reference to the microscope, and its CaptureManager object,
+        # who's capture paths will be modified
+        self.microscope: Optional[Microscope] = None
         self.capture_manager: Optional[CaptureManager] = None
         self.initial_location: str = get_default_location()
+        # (time, mount table, locations) from the last partition scan,
+        # see `get_cached_locations`
+        self._locations_cache: Optional[
+            Tuple[float, Optional[str], Dict[str, str]]
+        ] = None
+        # path: (expiry time, writeable), see `check_rw`
+        self._rw_cache: Dict[str, Tuple[float, bool]] = {}
 
         # Register the on_microscope function to run when the microscope is attached
         self.on_component("org.openflexure.microscope", self.on_microscope)
@@ -138,8 +215,11 @@ class AutostorageExtension(BaseExtension):
                 "Autostorage extension bound to CaptureManager %s", self.capture_manager
             )
 
-            # Store a reference to the CaptureManager
+            # Store a reference to the microscope and its CaptureManager
+            self.microscope = microscope_obj
             self.capture_manager = microscope_obj.captures
+            # Forget anything we found out about the filesystem before now
+            self.clear_caches()
             # Store the initial storage location
             self.initial_location = get_current_location(self.capture_manager)
 
@@ -157,26 +237,62 @@ class AutostorageExtension(BaseExtension):
         if not location:
             return False
         # If preferred path does not exist, or cannot be written to
-        if not (os.path.isdir(location) and check_rw(location)):
+        if not self.check_rw(location):
             logging.error(
                 "Preferred capture path %s is missing or cannot be written to. Restoring defaults.",
                 location,
             )
             # Reset the storage location to default
             set_current_location(self.capture_manager, get_default_location())
+            self.clear_caches()
         return True
 
+    def clear_caches(self):
+        """Forget cached locations, and whether directories are writeable"""
+        self._locations_cache = None
+        self._rw_cache.clear()
+
+    def check_rw(self, path: str) -> bool:
+        """Return `check_rw_dir(path)`, reusing results for a few seconds"""
+        now: float = time.monotonic()
+        cached: Optional[Tuple[float, bool]] = self._rw_cache.get(path)
+        if cached is None or now > cached[0]:
+            cached = (now + RW_CACHE_TTL, check_rw_dir(path))
+            self._rw_cache[path] = cached
+        return cached[1]
+
+    def get_cached_locations(self) -> Dict[str, str]:
+        """Return `get_all_locations()`, reusing recent results
+
+        Scanning partitions is slow, and a single form render asks for the
+        locations many times over, so results are kept for a couple of seconds,
+        or until a drive is mounted or unmounted.
+        """
+        now: float = time.monotonic()
+        mounts: Optional[str] = get_mounts_table()
+        if (
+            self._locations_cache is None
+            or now - self._locations_cache[0] > LOCATIONS_CACHE_TTL
+            or mounts != self._locations_cache[1]
+        ):
+            if self._locations_cache is not None and mounts != self._locations_cache[1]:
+                # Writeable directories may have come or gone with the drive
+                self._rw_cache.clear()
+            self._locations_cache = (now, mounts, get_all_locations(self.check_rw))
+        # Return a copy, as callers may add to it
+        return dict(self._locations_cache[2])
+
     def get_locations(self) -> Dict[str, str]:
-        if self.capture_manager:
-            locations = get_all_locations()
-
-            current_location = get_current_location(self.capture_manager)
-            if current_location not in locations.values():
-                locations.update({"Custom": current_location})
-            # Add location from the CaptureManager settings file
-            return locations
-        else:
+        capture_manager = self.capture_manager
+        if not capture_manager:
             return {}
+        locations = self.get_cached_locations()
+
+        # Add location from the CaptureManager settings file
+        current_location = capture_manager.paths.get("default", BASE_CAPTURE_PATH)
+        if current_location not in locations.values():
+            locations["Custom"] = current_location
+        return locations
 
     def get_preferred_key(self) -> Optional[str]:
         current = get_current_location(self.capture_manager)
@@ -196,32 +312,29 @@ class AutostorageExtension(BaseExtension):
             return None
 
     def set_preferred_key(self, new_path_key: str):
-        if not new_path_key in self.get_locations().keys():
-            raise KeyError(f"No location named {new_path_key}")
-
         location = self.get_locations().get(new_path_key)
+        if location is None:
+            raise KeyError(f"No location named {new_path_key}")
         if location:
             set_current_location(self.capture_manager, location)
+            self.clear_caches()
 
     def key_to_title(self, path_key: Optional[str]) -> Optional[str]:
         if not path_key:
             return None
-        if not path_key in self.get_locations().keys():
+        location = self.get_locations().get(path_key)
+        if location is None:
             raise KeyError(f"No location named {path_key}")
-        return f"{path_key} ({self.get_locations().get(path_key)})"
+        return f"{path_key} ({location})"
 
     def title_to_key(self, path_title: str) -> str:
-        matches = []
-        for loc_key in self.get_locations().keys():
-            if path_title.startswith(loc_key):
-                matches.append(loc_key)
-
-        if len(matches) > 1:
-            logging.warning(
-                "Multiple path matches found. Weird, but carrying on using zeroth."
-            )
-
-        return matches[0]
+        locations = self.get_locations()
+        # Titles are formatted as "{key} ({path})" by key_to_title. Compare
+        # whole titles, as keys (i.e. mount points) may themselves contain " ("
+        for key, location in locations.items():
+            if path_title == f"{key} ({location})":
+                return key
+        raise KeyError(f"No location titled {path_title}")
 
     def get_titles(self) -> List[str]:
         titles: List[str] = []
@@ -249,7 +362,7 @@ class PreferredLocationView(PropertyView):
         return self.extension.get_preferred_key()
 
     def post(self, new_path_key):
-        microscope = find_component("org.openflexure.microscope")
+        microscope = self.extension.microscope
 
         if not microscope:
             abort(503, "No microscope connected. Unable to autofocus.")
@@ -11,14 +11,26 @@ This module is only intended to be called from the OpenFlexure Microscope
 server, and depends on that server and its underlying LabThings library.
 """
 import io
+import itertools
 import json
 import logging
 import os
 import time
-from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import numpy as np
 import PIL
+
+try:
+    # libjpeg-turbo can decode straight to grayscale, much faster than PIL
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from camera_stage_mapping.camera_stage_calibration_1d import (
     calibrate_backlash_1d,
     image_to_stage_displacement_from_1d,
@@ -39,13 +51,34 @@ from openflexure_microscope.paths import data_file_path
 CSM_DATAFILE_NAME = "csm_calibration.json"
 CSM_DATAFILE_PATH = data_file_path(CSM_DATAFILE_NAME)
 
+#: Seconds to wait after each move before grabbing an image, unless the
+#: extension's "settle_time" setting says otherwise
+DEFAULT_SETTLE_TIME: float = 0.2
+
 CoordinateType = Tuple[float, float, float]
 XYCoordinateType = Tuple[float, float]
 
 
+def scan_path_to_array(
+    scan_path: Union[List[XYCoordinateType], np.ndarray]
+) -> np.ndarray:
+    """Convert a list of (x, y) points to an Nx2 float array
+
+    Arrays are passed through without copying.  Lists of points are flattened
+    with `np.fromiter`, which is much quicker than `np.array` on a list of tuples.
+    """
+    if isinstance(scan_path, np.ndarray):
+        return scan_path.reshape(-1, 2)
+    return np.fromiter(
+        itertools.chain.from_iterable(scan_path),
+        dtype=np.float64,
+        count=2 * len(scan_path),
+    ).reshape(-1, 2)
+
+
 class MoveHistory(NamedTuple):
-    times: List[float]
-    stage_positions: List[CoordinateType]
+    times: np.ndarray  # (N,) float
+    stage_positions: np.ndarray  # (N, 3) int
 
 
 class LoggingMoveWrapper:
@@ -59,6 +92,9 @@ class LoggingMoveWrapper:
     so we can estimate how long moves will take.
     """
 
+    #: Number of history entries to allocate space for initially
+    INITIAL_CAPACITY: int = 1024
+
     def __init__(self, move_function: Callable):
         self._move_function: Callable = move_function
         self._current_position: Optional[CoordinateType] = None
@@ -66,21 +102,38 @@ class LoggingMoveWrapper:
 
     def __call__(self, new_position: CoordinateType, *args, **kwargs):
         """Move to a new position, and record it"""
-        self._history.append((time.time(), self._current_position))
+        # Until we've made a move, we don't know where we're starting from
+        if self._current_position is not None:
+            self._record(self._current_position)
         self._move_function(new_position, *args, **kwargs)
         self._current_position = new_position
-        self._history.append((time.time(), self._current_position))
+        self._record(self._current_position)
+
+    def _record(self, position: CoordinateType):
+        """Log the current time and a position, growing the arrays if needed"""
+        if self._length == len(self._times):
+            self._times = np.resize(self._times, 2 * self._length)
+            self._positions = np.resize(self._positions, (2 * self._length, 3))
+        self._times[self._length] = time.time()
+        # The stage moves in whole steps, and reports its position as integers
+        self._positions[self._length] = np.rint(position)
+        self._length += 1
 
     @property
     def history(self) -> MoveHistory:
-        """The history, as a numpy array of times and another of positions"""
-        times: List[float] = [t for t, p in self._history if p is not None]
-        positions: List[CoordinateType] = [p for t, p in self._history if p is not None]
-        return MoveHistory(times, positions)
+        """The history, as a numpy array of times and another of positions
+
+        These are views of the recorded data, not copies.
+        """
+        return MoveHistory(self._times[: self._length], self._positions[: self._length])
 
     def clear_history(self):
-        """Reset our history to be an empty list"""
-        self._history: List[Tuple[float, Optional[CoordinateType]]] = []
+        """Reset our history to be empty"""
+        self._times: np.ndarray = np.empty(self.INITIAL_CAPACITY, dtype=np.float64)
+        self._positions: np.ndarray = np.empty(
+            (self.INITIAL_CAPACITY, 3), dtype=np.int64
+        )
+        self._length: int = 0
 
 
 class CSMUncalibratedError(RuntimeError):
@@ -121,6 +174,18 @@ class CSMExtension(BaseExtension):
             GetCalibrationFile, "/get_calibration", endpoint="get_calibration"
         )
 
+        # (modification time, size, contents) of the calibration file when read
+        self._calibration_file_cache: Optional[Tuple[int, int, dict]] = None
+        # Our settings, dropped when the microscope's entry for this extension
+        # is replaced or the settings file changes, and what they came from
+        self._settings_source: Optional[Dict[str, Any]] = None
+        self._settings_file_stat: Optional[Tuple[int, int]] = None
+        self._settings_cache: Optional[Dict[str, Any]] = None
+        # The displacement matrix as (m00, m01, m10, m11), and the setting it
+        # was made from
+        self._displacement_matrix: Optional[Tuple[float, float, float, float]] = None
+        self._displacement_source: Any = None
+
     _microscope: Optional[Microscope] = None
 
     @property
@@ -136,33 +201,91 @@ class CSMExtension(BaseExtension):
         dictionary: dict = create_from_path(keys)
         set_by_path(dictionary, keys, settings)
         logging.info("Updating settings with %s", dictionary)
+        self._settings_cache = None
+        self._displacement_matrix = None
         self.microscope.update_settings(dictionary)
         self.microscope.save_settings()
 
     def get_settings(self) -> Dict[str, Any]:
-        """Retrieve the settings for this extension"""
-        keys: List[str] = ["extensions", self.name]
+        """Retrieve the settings for this extension
+
+        Reading the microscope's settings involves the hardware and the settings
+        file, so the result is kept until `update_settings` is called, the
+        microscope's settings dictionary for this extension is replaced (as
+        `Microscope.update_settings` does), or the settings file changes.
+        """
+        source = self.microscope.extension_settings.get(self.name)
+        file_stat: Optional[Tuple[int, int]] = self._read_settings_file_stat()
+        if source is not self._settings_source or file_stat != self._settings_file_stat:
+            self._settings_source = source
+            self._settings_file_stat = file_stat
+            self._settings_cache = None
+        if self._settings_cache is None:
+            keys: List[str] = ["extensions", self.name]
+            try:
+                self._settings_cache = get_by_path(
+                    self.microscope.read_settings(), keys
+                )
+            except KeyError as exc:
+                raise CSMUncalibratedError(
+                    "Camera stage mapping calibration data is missing"
+                ) from exc
+        return self._settings_cache
+
+    def _read_settings_file_stat(self) -> Optional[Tuple[int, int]]:
+        """The (modification time, size) of the microscope's settings file"""
         try:
-            return get_by_path(self.microscope.read_settings(), keys)
-        except KeyError as exc:
-            raise CSMUncalibratedError(
-                "Camera stage mapping calibration data is missing"
-            ) from exc
+            stat = os.stat(self.microscope.settings_file.path)
+        except (AttributeError, OSError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read_calibration_file(self) -> dict:
+        """Return the contents of the calibration data file, or {} if missing
+
+        The parsed file is kept, and only read again if it has changed.
+        """
+        try:
+            stat = os.stat(CSM_DATAFILE_PATH)
+        except FileNotFoundError:
+            return {}
+        cache = self._calibration_file_cache
+        if cache is None or cache[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(CSM_DATAFILE_PATH, "rb") as f:
+                contents: bytes = f.read()
+            data: dict = orjson.loads(contents) if orjson else json.loads(contents)
+            cache = (stat.st_mtime_ns, stat.st_size, data)
+            self._calibration_file_cache = cache
+        return cache[2]
+
+    @property
+    def settle_time(self) -> float:
+        """Seconds to wait after each move, before grabbing an image"""
+        try:
+            return float(self.get_settings().get("settle_time", DEFAULT_SETTLE_TIME))
+        except CSMUncalibratedError:
+            return DEFAULT_SETTLE_TIME
 
     def camera_stage_functions(self) -> Tuple[Callable, Callable, Callable, Callable]:
         """Return functions that allow us to interface with the microscope"""
 
-        def grab_image():
+        def grab_image() -> np.ndarray:
+            # The tracker works in grayscale, so only decode the luminance
             jpeg: bytes = self.microscope.camera.get_frame()
-            return np.array(PIL.Image.open(io.BytesIO(jpeg)))
+            if simplejpeg is not None:
+                return simplejpeg.decode_jpeg(jpeg, colorspace="GRAY")[:, :, 0]
+            image = PIL.Image.open(io.BytesIO(jpeg))
+            image.draft("L", image.size)
+            return np.asarray(image.convert("L"))
 
         def get_position() -> CoordinateType:
             return self.microscope.stage.position
 
         move: Callable = self.microscope.stage.move_abs
+        settle_time: float = self.settle_time
 
         def wait():
-            time.sleep(0.2)
+            time.sleep(settle_time)
 
         return grab_image, get_position, move, wait
 
@@ -192,7 +315,8 @@ class CSMExtension(BaseExtension):
 
         # Combine X and Y calibrations to make a 2D calibration
         cal_xy: dict = image_to_stage_displacement_from_1d([cal_x, cal_y])
-        self.update_settings(cal_xy)
+        # Keep the settle time, as this replaces all of our settings
+        self.update_settings({**cal_xy, "settle_time": self.settle_time})
 
         data: Dict[str, dict] = {
             "camera_stage_mapping_calibration": cal_xy,
@@ -200,8 +324,10 @@ class CSMExtension(BaseExtension):
             "linear_calibration_y": cal_y,
         }
 
+        # json.dumps (unlike json.dump) goes through JSONEncoder.encode, which
+        # serialises NumPy arrays with orjson when it's available
         with open(CSM_DATAFILE_PATH, "w") as f:
-            json.dump(data, f, cls=JSONEncoder)
+            f.write(json.dumps(data, cls=JSONEncoder))
 
         return data
 
@@ -218,10 +344,22 @@ class CSMExtension(BaseExtension):
 
     def move_in_image_coordinates(self, displacement_in_pixels: XYCoordinateType):
         """Move by a given number of pixels on the camera"""
-        relative_move: np.ndarray = np.dot(
-            np.array(displacement_in_pixels), self.image_to_stage_displacement_matrix
-        )
-        self.microscope.stage.move_rel([relative_move[0], relative_move[1], 0])
+        # Make the matrix again if the calibration has changed, even in place
+        source: Any = self.get_settings().get("image_to_stage_displacement")
+        if self._displacement_matrix is None or source is not self._displacement_source:
+            matrix: np.ndarray = self.image_to_stage_displacement_matrix
+            self._displacement_matrix = (
+                float(matrix[0, 0]),
+                float(matrix[0, 1]),
+                float(matrix[1, 0]),
+                float(matrix[1, 1]),
+            )
+            self._displacement_source = source
+        m00, m01, m10, m11 = self._displacement_matrix
+        # Equivalent to np.dot(displacement_in_pixels, matrix), without NumPy
+        # overhead for such a tiny product
+        dx, dy = displacement_in_pixels
+        self.microscope.stage.move_rel([dx * m00 + dy * m10, dx * m01 + dy * m11, 0])
 
     def closed_loop_move_in_image_coordinates(
         self, displacement_in_pixels: XYCoordinateType, **kwargs
@@ -239,7 +377,7 @@ class CSMExtension(BaseExtension):
         )
 
     def closed_loop_scan(
-        self, scan_path: List[XYCoordinateType], **kwargs
+        self, scan_path: Union[List[XYCoordinateType], np.ndarray], **kwargs
     ) -> List[CoordinateType]:
         """Perform closed-loop moves to each point defined in scan_path.
 
@@ -265,7 +403,11 @@ class CSMExtension(BaseExtension):
         tracker.acquire_template()
 
         return closed_loop_scan(
-            tracker, self.move_in_image_coordinates, move, np.array(scan_path), **kwargs
+            tracker,
+            self.move_in_image_coordinates,
+            move,
+            scan_path_to_array(scan_path),
+            **kwargs
         )
 
     def test_closed_loop_spiral_scan(
@@ -359,10 +501,4 @@ class TestClosedLoopSpiralScanView(ActionView):
 class GetCalibrationFile(PropertyView):
     def get(self):
         """Get the calibration data in JSON format."""
-        datafile_path = CSM_DATAFILE_PATH
-
-        if os.path.isfile(datafile_path):
-            with open(datafile_path, "rb") as f:
-                return json.load(f)
-        else:
-            return {}
+        return self.extension.read_calibration_file()
@@ -39,6 +39,18 @@ import numpy as np
 from picamerax import PiCamera
 from picamerax.array import PiBayerArray, PiRGBArray
 
+try:
+    # Numba compiles the lens shading table's box averages, but isn't required
+    import numba
+except ImportError:
+    numba = None
+
+#: Only every COARSE_STRIDEth pixel is used while adjusting the exposure
+COARSE_STRIDE: int = 4
+
+#: Size of the images used for the first adjustments to an RGB setpoint
+SETPOINT_PREVIEW_RESOLUTION: Tuple[int, int] = (320, 240)
+
 
 def rgb_image(
     camera: PiCamera, resize: Optional[Tuple[int, int]] = None, **kwargs
@@ -61,18 +73,20 @@ def flat_lens_shading_table(camera: PiCamera) -> np.ndarray:
             "This program requires the forked picamera library with lens shading support"
         )
     # pylint: disable=protected-access
-    return np.zeros(camera._lens_shading_table_shape(), dtype=np.uint8) + 32
+    return np.full(camera._lens_shading_table_shape(), 32, dtype=np.uint8)
 
 
 def adjust_exposure_to_setpoint(camera: PiCamera, setpoint: int):
     """Adjust the camera's exposure time until the maximum pixel value is <setpoint>.
     
     NB this method uses RGB images (i.e. processed ones) not raw images.
+    The first adjustments use small images, which the GPU resizes, and only
+    the last one uses a full resolution image.
     """
     logging.info(f"Adjusting shutter speed to hit setpoint {setpoint}")
-    for _ in range(3):
+    for resize in [SETPOINT_PREVIEW_RESOLUTION, SETPOINT_PREVIEW_RESOLUTION, None]:
         camera.shutter_speed = int(
-            camera.shutter_speed * setpoint / np.max(rgb_image(camera))
+            camera.shutter_speed * setpoint / np.max(rgb_image(camera, resize=resize))
         )
         time.sleep(1)
 
@@ -103,15 +117,26 @@ class ExposureTest(NamedTuple):
     analog_gain: float
 
 
-def test_exposure_settings(camera: PiCamera, percentile: float) -> ExposureTest:
+def test_exposure_settings(
+    camera: PiCamera, percentile: float, stride: int = 1
+) -> ExposureTest:
     """Evaluate current exposure settings using a raw image
 
     We will acquire a raw image and calculate the given percentile
     of the pixel values.  We return a dictionary containing the
     percentile (which will be compared to the target), as well as
-    the camera's shutter and gain values.
+    the camera's shutter and gain values.  If ``stride`` is more than
+    1, only every ``stride``th pixel in each direction is used.
     """
-    max_brightness = np.max(get_channel_percentiles(camera, percentile))
+    channels = capture_channels(camera)[:, ::stride, ::stride]
+    return exposure_test_from_channels(camera, channels, percentile)
+
+
+def exposure_test_from_channels(
+    camera: PiCamera, channels: np.ndarray, percentile: float
+) -> ExposureTest:
+    """Evaluate the exposure settings used to capture some raw channels"""
+    max_brightness = np.max(channel_percentiles(channels, percentile) - 64)
     # The reported brightness can, theoretically, be negative or zero
     # because of black level compensation.  The line below forces a
     # minimum value of 1 which will keep things well-behaved!
@@ -138,6 +163,25 @@ def check_convergence(test: ExposureTest, target: int, tolerance: float):
     return converged
 
 
+def test_exposure_convergence(
+    camera: PiCamera, percentile: float, target: int, tolerance: float
+) -> Tuple[ExposureTest, bool]:
+    """Test the exposure on a coarse grid, confirming convergence at full resolution
+
+    The percentile of a subsampled image is close enough to steer the
+    shutter speed and gain, and is much quicker to calculate.  Once that
+    says we have converged, we check again using every pixel of the same
+    raw image.
+    """
+    channels = capture_channels(camera)
+    coarse_channels = channels[:, ::COARSE_STRIDE, ::COARSE_STRIDE]
+    test = exposure_test_from_channels(camera, coarse_channels, percentile)
+    if not check_convergence(test, target, tolerance):
+        return test, False
+    test = exposure_test_from_channels(camera, channels, percentile)
+    return test, check_convergence(test, target, tolerance)
+
+
 def adjust_shutter_and_gain_from_raw(
     camera: PiCamera,
     target_white_level: int = 700,
@@ -184,9 +228,11 @@ def adjust_shutter_and_gain_from_raw(
     # shutter speed any more.
     iterations = 0
     while iterations < max_iterations:
-        test = test_exposure_settings(camera, percentile)
+        test, converged = test_exposure_convergence(
+            camera, percentile, target_white_level, tolerance
+        )
 
-        if check_convergence(test, target_white_level, tolerance):
+        if converged:
             break
         iterations += 1
 
@@ -203,10 +249,9 @@ def adjust_shutter_and_gain_from_raw(
             break
 
     # Now, if we've not converged, increase gain until we converge or run out of options.
-    while iterations < max_iterations:
-        test = test_exposure_settings(camera, percentile)
-        if check_convergence(test, target_white_level, tolerance):
-            break
+    # If we get here with iterations to spare, the shutter speed has maxed out, so
+    # the settings haven't changed since the last test, and we can start from it.
+    while not converged and iterations < max_iterations:
         iterations += 1
 
         # Adjust gain to make the white level hit the target, again with a maximum
@@ -218,6 +263,10 @@ def adjust_shutter_and_gain_from_raw(
             logging.info("Gain has maxed out.")
             break
 
+        test, converged = test_exposure_convergence(
+            camera, percentile, target_white_level, tolerance
+        )
+
     if check_convergence(test, target_white_level, tolerance):
         logging.info(f"Brightness has converged to within {tolerance * 100 :.0f}%.")
     else:
@@ -238,7 +287,17 @@ def adjust_white_balance_from_raw(
     We should probably have better logic to verify the channels really
     are BGGR...
     """
-    blue, g1, g2, red = get_channel_percentiles(camera, percentile)
+    new_awb_gains = white_balance_from_channels(capture_channels(camera), percentile)
+    camera.awb_mode = "off"
+    camera.awb_gains = new_awb_gains
+    return new_awb_gains
+
+
+def white_balance_from_channels(
+    channels: np.ndarray, percentile: float = 99
+) -> Tuple[float, float]:
+    """Calculate the AWB gains that make the brightest raw pixels neutral"""
+    blue, g1, g2, red = channel_percentiles(channels, percentile) - 64
     green = (g1 + g2) / 2.0
     new_awb_gains = (green / red, green / blue)
     logging.info(
@@ -246,30 +305,63 @@ def adjust_white_balance_from_raw(
         f"setting AWB gains to ({new_awb_gains[0]:.2f}, "
         f"{new_awb_gains[1]:.2f})."
     )
-    camera.awb_mode = "off"
-    camera.awb_gains = new_awb_gains
     return new_awb_gains
 
 
 def channels_from_bayer_array(bayer_array: np.ndarray) -> np.ndarray:
-    """Given the 'array' from a PiBayerArray, return the 4 channels."""
-    bayer_pattern: List[Tuple[int, int]] = [(0, 0), (0, 1), (1, 0), (1, 1)]
-    channels_shape: Tuple[int, ...] = (
-        4,
-        bayer_array.shape[0] // 2,
-        bayer_array.shape[1] // 2,
-    )
-    channels: np.ndarray = np.zeros(channels_shape, dtype=bayer_array.dtype)
-    for i, offset in enumerate(bayer_pattern):
-        # We simplify life by dealing with only one channel at a time.
-        channels[i, :, :] = np.sum(
-            bayer_array[offset[0] :: 2, offset[1] :: 2, :], axis=2
-        )
+    """Given the 'array' from a PiBayerArray, return the 4 channels.
+
+    The channels are in the order of their offsets in the 2x2 Bayer cell, i.e.
+    (0, 0), (0, 1), (1, 0), (1, 1).  They are all extracted in a single pass,
+    by viewing the array as blocks of 2x2 pixels.
+    """
+    height: int = bayer_array.shape[0] // 2
+    width: int = bayer_array.shape[1] // 2
+    # Each pixel is non-zero in only one colour plane, so summing the planes
+    # gives a 2D raw image.  Adding whole planes is much quicker than summing
+    # along the short last axis.
+    summed: np.ndarray = np.add(bayer_array[:, :, 0], bayer_array[:, :, 1])
+    summed += bayer_array[:, :, 2]
+    # Then split it into (row offset, column offset)
+    blocks: np.ndarray = summed.reshape(height, 2, width, 2)
+    return np.ascontiguousarray(blocks.transpose(1, 3, 0, 2)).reshape(4, height, width)
+
+
+def capture_channels(camera: PiCamera) -> np.ndarray:
+    """Acquire a raw image and return its 4 Bayer channels.
+
+    The channels are a new array, so the raw image needn't be copied.
+    """
+    with PiBayerArray(camera) as output:
+        camera.capture(output, format="jpeg", bayer=True)
+        return channels_from_bayer_array(output.array)
 
-    return channels
 
+def channel_percentiles(channels: np.ndarray, percentile: float) -> np.ndarray:
+    """Calculate a percentile of each channel, like ``np.percentile(..., axis=(1, 2))``
 
-def get_channel_percentiles(camera: PiCamera, percentile: float) -> np.ndarray:
+    Raw pixel values are small, non-negative integers, so rather than sorting
+    millions of pixels we count how many there are of each value, and find the
+    percentile (interpolated linearly, as NumPy does) from the running total.
+    """
+    if channels.dtype.kind != "u":
+        return np.percentile(channels, percentile, axis=(1, 2))
+    percentiles: np.ndarray = np.empty(channels.shape[0], dtype=float)
+    for i, channel in enumerate(channels):
+        # cumulative[v] is the number of pixels with a value <= v
+        cumulative: np.ndarray = np.cumsum(np.bincount(channel.ravel(), minlength=1024))
+        # Position of the percentile in the sorted pixels, and its neighbours
+        position: float = percentile / 100 * (cumulative[-1] - 1)
+        below: int = int(position)
+        above: int = min(below + 1, int(cumulative[-1]) - 1)
+        lower, upper = np.searchsorted(cumulative, [below, above], side="right")
+        percentiles[i] = lower + (upper - lower) * (position - below)
+    return percentiles
+
+
+def get_channel_percentiles(
+    camera: PiCamera, percentile: float, stride: int = 1
+) -> np.ndarray:
     """Calculate the brightness percentile of the pixels in each channel
     
     This is a number between -64 and 959 for each channel, because the
@@ -277,15 +369,45 @@ def get_channel_percentiles(camera: PiCamera, percentile: float) -> np.ndarray:
     at 64 for denoising purposes (there's black level compensation built
     in, and to avoid skewing the noise, the black level is set as 64 to
     leave some room for negative values.
+
+    If ``stride`` is more than 1, only every ``stride``th pixel in each
+    direction is used, which is quicker but less precise.
     """
-    with PiBayerArray(camera) as output:
-        camera.capture(output, format="jpeg", bayer=True)
-        channels = channels_from_bayer_array(output.array)
-        return np.percentile(channels, percentile, axis=(1, 2)) - 64
+    channels = capture_channels(camera)[:, ::stride, ::stride]
+    return channel_percentiles(channels, percentile) - 64
+
 
+if numba is not None:
 
-def lst_from_channels(channels: np.ndarray) -> np.ndarray:
-    """Given the 4 Bayer colour channels from a white image, generate a LST."""
+    @numba.njit(nogil=True, parallel=True, cache=True)
+    def _fill_ls_channel(image_channel: np.ndarray, ls_channel: np.ndarray, box: int):
+        """Average a box x box square at the centre of each 32x32 block of pixels
+
+        The black level (64) is subtracted, and the result written to ls_channel.
+        Blocks past the edge of the image use the nearest edge pixels.
+        """
+        iw, ih = image_channel.shape
+        lw, lh = ls_channel.shape
+        half = box // 2
+        for i in numba.prange(lw):
+            for j in range(lh):
+                total = 0
+                for dx in range(-half, box - half):
+                    x = min(16 + 32 * i + dx, iw - 1)
+                    for dy in range(-half, box - half):
+                        y = min(16 + 32 * j + dy, ih - 1)
+                        total += np.int64(image_channel[x, y])
+                ls_channel[i, j] = total / box ** 2 - 64
+
+
+def lst_from_channels(
+    channels: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Given the 4 Bayer colour channels from a white image, generate a LST.
+
+    If ``out`` is given, it must be a uint8 array of the right shape, and
+    the table is written into it rather than into a new array.
+    """
     full_resolution: np.ndarray = np.array(
         channels.shape[1:]
     ) * 2  # channels have been binned
@@ -307,34 +429,39 @@ def lst_from_channels(channels: np.ndarray) -> np.ndarray:
         lh: int
         lw, lh = ls_channel.shape
         # The lens shading table is rounded **up** in size to 1/64th of the size of
-        # the image.  Rather than handle edge images separately, I'm just going to
-        # pad the image by copying edge pixels, so that it is exactly 32 times the
-        # size of the lens shading table (NB 32 not 64 because each channel is only
-        # half the size of the full image - remember the Bayer pattern...  This
-        # should give results very close to 6by9's solution, albeit considerably
-        # less computationally efficient!
-        padded_image_channel: np.ndarray = np.pad(
-            image_channel, [(0, lw * 32 - iw), (0, lh * 32 - ih)], mode="edge"
-        )  # Pad image to the right and bottom
+        # the image.  Rather than handle edge images separately, I'm treating the
+        # image as if it were padded by copying edge pixels, so that it is exactly
+        # 32 times the size of the lens shading table (NB 32 not 64 because each
+        # channel is only half the size of the full image - remember the Bayer
+        # pattern...  This should give results very close to 6by9's solution.
+        # Rather than copying the image to pad it, indices past the right and
+        # bottom edges are clamped to the last row/column.
         logging.info(
-            "Channel shape: %sx%s, shading table shape: %sx%s, after padding %s",
+            "Channel shape: %sx%s, shading table shape: %sx%s, covering %sx%s",
             iw,
             ih,
+            lw,
+            lh,
             lw * 32,
             lh * 32,
-            padded_image_channel.shape,
         )
-        # Next, fill the shading table (except edge pixels).  Please excuse the
-        # for loop - I know it's not fast but this code needn't be!
+        # Next, fill the shading table (except edge pixels).
         box: int = 3  # We average together a square of this side length for each pixel.
         # NB this isn't quite what 6by9's program does - it averages 3 pixels
         # horizontally, but not vertically.
-        for dx in np.arange(box) - box // 2:
-            for dy in np.arange(box) - box // 2:
-                ls_channel[:, :] += (
-                    padded_image_channel[16 + dx :: 32, 16 + dy :: 32] - 64
-                )
-        ls_channel /= box ** 2
+        if numba is not None:
+            _fill_ls_channel(image_channel, ls_channel, box)
+        else:
+            # Sum the box in integers, and only subtract the black level once
+            total: np.ndarray = np.zeros((lw, lh), dtype=np.int32)
+            for dx in np.arange(box) - box // 2:
+                rows: np.ndarray = np.minimum(np.arange(16 + dx, lw * 32, 32), iw - 1)
+                for dy in np.arange(box) - box // 2:
+                    cols: np.ndarray = np.minimum(
+                        np.arange(16 + dy, lh * 32, 32), ih - 1
+                    )
+                    total += image_channel[np.ix_(rows, cols)]
+            np.subtract(total / box ** 2, 64, out=ls_channel)
         # The original C code written by 6by9 normalises to the central 64 pixels in each channel.
         # ls_channel /= np.mean(image_channel[iw//2-4:iw//2+4, ih//2-4:ih//2+4])
         # I have had better results just normalising to the maximum:
@@ -347,25 +474,25 @@ def lst_from_channels(channels: np.ndarray) -> np.ndarray:
 
     # What we actually want to calculate is the gains needed to compensate for the
     # lens shading - that's 1/lens_shading_table_float as we currently have it.
-    gains: np.ndarray = 32.0 / lens_shading  # 32 is unity gain
-    gains[gains > 255] = 255  # clip at 255, maximum gain is 255/32
-    gains[gains < 32] = 32  # clip at 32, minimum gain is 1 (is this necessary?)
-    lens_shading_table: np.ndarray = gains.astype(np.uint8)
-    return lens_shading_table[::-1, :, :].copy()
+    # 32 is unity gain.  The gains overwrite lens_shading, as it isn't needed again.
+    gains: np.ndarray = np.divide(32.0, lens_shading, out=lens_shading)
+    # clip at 255 (maximum gain is 255/32) and 32 (minimum gain is 1, is this
+    # necessary?) in place
+    np.clip(gains, 32, 255, out=gains)
+    if out is None:
+        # Casting the flipped view gives a new, contiguous table in one pass
+        return gains[::-1, :, :].astype(np.uint8, order="C")
+    np.copyto(out, gains[::-1, :, :], casting="unsafe")
+    return out
 
 
 def lst_from_camera(camera: PiCamera) -> np.ndarray:
     """Acquire a raw image and use it to calculate a lens shading table."""
-    with PiBayerArray(camera) as a:
-        camera.capture(a, format="jpeg", bayer=True)
-        raw_image = a.array.copy()
-
     # Now we need to calculate a lens shading table that would make this flat.
-    # raw_image is a 3D array, with full resolution and 3 colour channels.  No
+    # The raw image is a 3D array, with full resolution and 3 colour channels.  No
     # de-mosaicing has been done, so 2/3 of the values are zero (3/4 for R and B
     # channels, 1/2 for green because there's twice as many green pixels).
-    channels = channels_from_bayer_array(raw_image)
-    return lst_from_channels(channels)
+    return lst_from_channels(capture_channels(camera))
 
 
 def recalibrate_camera(camera: PiCamera):
@@ -374,6 +501,8 @@ def recalibrate_camera(camera: PiCamera):
     This method first resets to a flat lens shading table, then auto-exposes,
     then generates a new lens shading table to make the current view uniform.
     It should be run when the camera is looking at a uniform white scene.
+    The same raw image is used to set the white balance: the raw channels
+    aren't affected by the lens shading table or the AWB gains.
 
     NB the only parameter ``camera`` is a ``PiCamera`` instance and **not** a
     ``StreamingCamera``.
@@ -381,18 +510,11 @@ def recalibrate_camera(camera: PiCamera):
     camera.lens_shading_table = flat_lens_shading_table(camera)
     _ = rgb_image(camera)  # for some reason the camera won't work unless I do this!
 
-    lens_shading_table = lst_from_camera(camera)
-
-    camera.lens_shading_table = lens_shading_table
-    _ = rgb_image(camera)
+    channels = capture_channels(camera)
+    camera.lens_shading_table = lst_from_channels(channels)
 
     # Fix the AWB gains so the image is neutral
-    channel_means = np.mean(np.mean(rgb_image(camera), axis=0, dtype=float), axis=0)
-    old_gains = camera.awb_gains
-    camera.awb_gains = (
-        channel_means[1] / channel_means[0] * old_gains[0],
-        channel_means[1] / channel_means[2] * old_gains[1],
-    )
+    camera.awb_gains = white_balance_from_channels(channels)
     time.sleep(1)
     # Ensure the background is bright but not saturated
     adjust_exposure_to_setpoint(camera, 230)
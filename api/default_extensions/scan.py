@@ -26,6 +26,9 @@ from openflexure_microscope.microscope import Microscope
 XyCoordinate = Tuple[int, int]
 XyzCoordinate = Tuple[int, int, int]
 
+#: The directions of the sides of each shell of a spiral scan, in order
+SPIRAL_DIRECTIONS: np.ndarray = np.array([[1, 0], [0, -1], [-1, 0], [0, 1]])
+
 
 ### Grid construction
 
@@ -44,6 +47,7 @@ class FocusManager:
     current_image_is_background_function: Optional[Callable] = None
     autofocus_function: Optional[Callable] = None
     axial_jump_threshold: Optional[float] = None
+    INITIAL_CAPACITY: int = 64
 
     def __init__(
         self,
@@ -77,6 +81,12 @@ class FocusManager:
         """
         self.initial_position = initial_position
         self.focused_positions = []
+        # XY of the focused positions, grown as needed so it isn't rebuilt per lookup
+        self._focused_xy: np.ndarray = np.empty(
+            (self.INITIAL_CAPACITY, 2), dtype=np.int64
+        )
+        # The last lookup, as ((XY position, number of focused points), result)
+        self._closest_cache: Optional[Tuple[tuple, Optional[XyzCoordinate]]] = None
         self.microscope = microscope
         self.autofocus_function = autofocus_function
         if not autofocus_function:
@@ -86,11 +96,28 @@ class FocusManager:
 
     def record_focused_point(self, position: XyzCoordinate):
         """Add a position to the list of successfully-focused points"""
+        length = len(self.focused_positions)
+        if length == len(self._focused_xy):
+            self._focused_xy = np.resize(self._focused_xy, (2 * length, 2))
+        self._focused_xy[length] = position[:2]
         self.focused_positions.append(position)
 
     def closest_focused_point(self, position: XyCoordinate) -> Optional[XyzCoordinate]:
-        """The closest point in our list of focused points to a given XY position."""
-        return closest_point_in_xy(position, self.focused_positions)
+        """The closest point in our list of focused points to a given XY position.
+
+        Each tile looks up the same position several times, so the last result
+        is kept until we look somewhere else or a new point is recorded.
+        """
+        length = len(self.focused_positions)
+        key = (tuple(position[:2]), length)
+        if self._closest_cache and self._closest_cache[0] == key:
+            return self._closest_cache[1]
+        closest: Optional[XyzCoordinate] = None
+        if length > 0:
+            index = closest_index_in_xy(position, self._focused_xy[:length])
+            closest = self.focused_positions[index]
+        self._closest_cache = (key, closest)
+        return closest
 
     def estimate_z(self, position: XyCoordinate) -> int:
         """Estimate the z position most likely to be in focus at an XY point
@@ -127,10 +154,11 @@ class FocusManager:
         closest_focused_point = self.closest_focused_point(position[:2])
         if not closest_focused_point:
             return False
-        move = np.array(position) - np.array(closest_focused_point)
-        lateral_move = np.sqrt(np.sum(move[:2] ** 2))
-        axial_move = np.abs(move[2])
-        return axial_move > lateral_move * self.axial_jump_threshold
+        # Plain arithmetic is much quicker than numpy for a few scalars, and
+        # comparing squared distances avoids the square root
+        dx, dy, dz = (a - b for a, b in zip(position, closest_focused_point))
+        lateral_move_sq = dx * dx + dy * dy
+        return dz * dz > lateral_move_sq * self.axial_jump_threshold ** 2
 
     def autofocus(self):
         """Perform an autofocus routine.
@@ -164,6 +192,42 @@ class FocusManager:
             self.record_focused_point(here)
 
 
+def _construct_path(
+    initial: XyCoordinate,
+    step_sizes: XyCoordinate,
+    n_steps: XyCoordinate,
+    style: Literal["raster", "snake", "spiral"] = "raster",
+) -> np.ndarray:
+    """Construct the coordinates for a scan, in order, as an N-by-2 array."""
+    if style == "spiral":
+        # Build the spiral from the steps between each point and the next.
+        # The centre image comes first, with no step.
+        # for spiral, n_steps is the number of shells, and so only requires n_steps[0]
+        steps: List[np.ndarray] = [np.zeros((1, 2), dtype=int)]
+        for i in range(2, n_steps[0] + 1):
+            side_length = (2 * i) - 1
+            # Go round the shell, in each direction in turn
+            shell_steps = np.repeat(SPIRAL_DIRECTIONS, side_length - 1, axis=0)
+            # The first step also moves out from the last shell, to the shell's corner
+            shell_steps[0] += [-1, 1]
+            steps.append(shell_steps)
+        return initial + np.cumsum(np.concatenate(steps) * step_sizes, axis=0)
+
+    # If raster or snake, build all the coordinates at once, as an (x, y, 2) array
+    i = np.arange(n_steps[0])[:, np.newaxis]
+    j = np.arange(n_steps[1])
+
+    # Style modifiers
+    if style == "snake":
+        # Count y backwards in every odd line (row)
+        j = np.where(i % 2 == 0, j, n_steps[1] - 1 - j)
+
+    xs = initial[0] + i * step_sizes[0]
+    ys = initial[1] + j * step_sizes[1]
+    grid = np.stack(np.broadcast_arrays(xs, ys), axis=-1)
+    return grid.reshape(-1, 2)
+
+
 def construct_grid(
     initial: XyCoordinate,
     step_sizes: XyCoordinate,
@@ -174,58 +238,20 @@ def construct_grid(
     Given an initial position, step sizes, and number of steps,
     construct a 2-dimensional list of scan x-y positions.
     """
-    arr: List[List[XyCoordinate]] = []  # 2D array of coordinates
-
+    path = construct_grid_1d(
+        initial=initial, step_sizes=step_sizes, n_steps=n_steps, style=style
+    )
     if style == "spiral":
-        # deal with the centre image immediately
-        coord = initial
-        arr.append([initial])
-        # for spiral, n_steps is the number of shells, and so only requires n_steps[0]
-        for i in range(2, n_steps[0] + 1):
-            arr.append([])  # Append new shell holder
-            side_length = (2 * i) - 1
-
-            # Iteratively generate the next location to append
-
-            # Start coordinate of the shell
-            # We create a copy of coord so that the new value of coord doesn't depend on itself
-            # Otherwise we create a generator, not a tuple, which makes type checking angry
-            last_coordinate: XyCoordinate = coord
-            coord = (
-                last_coordinate[0] + [-1, 1][0] * step_sizes[0],
-                last_coordinate[1] + [-1, 1][1] * step_sizes[1],
-            )
-            for direction in ([1, 0], [0, -1], [-1, 0], [0, 1]):
-                for _ in range(side_length - 1):
-                    last_coordinate = coord
-                    coord = (
-                        last_coordinate[0] + direction[0] * step_sizes[0],
-                        last_coordinate[1] + direction[1] * step_sizes[1],
-                    )
-                    arr[i - 1].append(coord)
-
-    # If raster or snake
+        # Each shell of the spiral is a line: the centre, then 8 more per shell
+        line_lengths = [1] + [8 * (i - 1) for i in range(2, n_steps[0] + 1)]
     else:
-        for i in range(n_steps[0]):  # x axis
-            arr.append([])
-            for j in range(n_steps[1]):  # y axis
-                # Create a coordinate tuple
-                coord = (
-                    initial[0] + [i, j][0] * step_sizes[0],
-                    initial[1] + [i, j][1] * step_sizes[1],
-                )
-                # Append coordinate array to position grid
-                arr[i].append(coord)
-
-        # Style modifiers
-        if style == "snake":
-            # For each line (row) in the coordinate array
-            for i, line in enumerate(arr):
-                # If it's an odd row
-                if i % 2 != 0:
-                    # Reverse the list of coordinates
-                    line.reverse()
+        line_lengths = [n_steps[1]] * n_steps[0]
 
+    arr: List[List[XyCoordinate]] = []  # 2D array of coordinates
+    start = 0
+    for length in line_lengths:
+        arr.append(path[start : start + length])
+        start += length
     return arr
 
 
@@ -240,13 +266,11 @@ def construct_grid_1d(
     This is the same set of coordinates returned by `construct_grid`
     but the list-of-lists is flattened to a simple list.
     """
-    path = []
-    grid = construct_grid(
+    path = _construct_path(
         initial=initial, step_sizes=step_sizes, n_steps=n_steps, style=style
     )
-    for line in grid:
-        path += line  # concatenate the lists
-    return path
+    # Convert to a list of tuples of Python ints
+    return [(x, y) for x, y in path.tolist()]
 
 
 def closest_point_in_xy(
@@ -262,15 +286,23 @@ def closest_point_in_xy(
     if len(points) < 1:
         return None
     points_2d = np.asarray(points)[:, :2]
+    return points[closest_index_in_xy(current_position, points_2d)]
+
 
-    squared_distances = np.sum((points_2d - current_position) ** 2, axis=1)
+def closest_index_in_xy(current_position: XyCoordinate, points_2d: np.ndarray) -> int:
+    """Find the index of the closest point in an N-by-2 array of XY positions
+
+    In the event of a tie, the last index is returned.
+    """
+    displacements = points_2d - current_position
+    squared_distances = np.einsum("ij,ij->i", displacements, displacements)
     # We reverse the distances before searching, as argmin will return the first
     # point in the event of there being multiple points with the same minimum,
     # and we want to pick the last one.
     reverse_min_index = np.argmin(squared_distances[::-1])
     # of course, now we must convert the index to be the right way round
-    min_index = len(points) - 1 - reverse_min_index
-    return points[int(min_index)]  # The explicit cast is necessary for MyPy
+    min_index = len(points_2d) - 1 - reverse_min_index
+    return int(min_index)  # The explicit cast is necessary for MyPy
 
 
 ### Capturing
@@ -282,6 +314,8 @@ class ScanExtension(BaseExtension):
 
         self._images_to_be_captured: int = 1
         self._images_captured_so_far: int = 0
+        # Number of digits needed to number every image in the scan
+        self._image_number_width: int = 1
 
         self.add_view(TileScanAPI, "/tile", endpoint="tile")
 
@@ -305,15 +339,12 @@ class ScanExtension(BaseExtension):
 
         # Construct a tile filename
         if namemode == "coordinates":
-            filename = "{}_{}_{}_{}".format(basename, *microscope.stage.position)
+            x, y, z = microscope.stage.position
+            filename = f"{basename}_{x}_{y}_{z}"
         else:
-            filename = "{}_{}".format(
-                basename,
-                str(self._images_captured_so_far).zfill(
-                    len(str(self._images_to_be_captured))
-                ),
-            )
-        folder = "SCAN_{}".format(basename)
+            image_number = self._images_captured_so_far
+            filename = f"{basename}_{image_number:0{self._image_number_width}d}"
+        folder = f"SCAN_{basename}"
 
         # Do capture
         return microscope.capture(
@@ -427,6 +458,7 @@ class ScanExtension(BaseExtension):
         # Keep task progress
         self._images_to_be_captured = len(path)
         self._images_captured_so_far = 0
+        self._image_number_width = len(str(self._images_to_be_captured))
 
         # Generate a basename if none given
         if not basename:
@@ -1,3 +1,13 @@
+from collections import OrderedDict
+
+import yaml
+
+try:
+    # libyaml's emitter is much faster than the pure-Python one
+    from yaml import CDumper as _BaseDumper
+except ImportError:
+    from yaml import Dumper as _BaseDumper  # type: ignore[misc]
+
 API_TAGS = [
     {
         "name": "actions",
@@ -34,3 +44,19 @@ def add_spec_extras(spec):
     # Add a list of tags, so we can control ordering and add descriptions
     for t in API_TAGS:
         spec.tag(t)
+
+
+class SpecYAMLDumper(_BaseDumper):  # type: ignore[misc, valid-type]
+    """A YAML dumper matching apispec's, keeping the order of OrderedDicts"""
+
+    @staticmethod
+    def _represent_dict(dumper, instance):
+        return dumper.represent_mapping("tag:yaml.org,2002:map", instance.items())
+
+
+SpecYAMLDumper.add_representer(OrderedDict, SpecYAMLDumper._represent_dict)
+
+
+def spec_to_yaml(spec_dict: dict) -> str:
+    """Render an OpenAPI spec dictionary (from `APISpec.to_dict`) as YAML"""
+    return yaml.dump(spec_dict, Dumper=SpecYAMLDumper)
@@ -0,0 +1,185 @@
+import logging
+import os
+import queue
+import socket
+import threading
+from typing import Callable, List, Optional
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import FileWrapper
+
+#: URL prefix of long-lived streaming routes, served from their own pool
+STREAMS_PATH_PREFIX: bytes = b"/api/v2/streams/"
+
+#: Minimum block size used when sending files (e.g. logs and captures)
+FILE_WRAPPER_BUFFER_SIZE: int = 256 * 1024
+
+#: Seconds to wait for a new connection's request line, to see if it's a stream
+PEEK_TIMEOUT: float = 2.0
+
+#: WSGI environ key of a ``threading.Event`` that is set when the server stops
+SERVER_STOPPING_KEY: str = "openflexure.server_stopping"
+
+
+def file_wrapper(file, buffer_size: int = 8192) -> FileWrapper:
+    """A ``wsgi.file_wrapper`` reading files in large blocks"""
+    return FileWrapper(file, max(buffer_size, FILE_WRAPPER_BUFFER_SIZE))
+
+
+class PooledWSGIRequestHandler(WSGIRequestHandler):
+    """
+    Request handler providing ``wsgi.file_wrapper``.
+
+    Flask's ``send_file`` asks for 8 KB blocks, so without this a 1 MB log
+    download takes over a hundred read and socket write calls.
+    """
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ["wsgi.file_wrapper"] = file_wrapper
+        stopping: Optional[threading.Event] = getattr(self.server, "stopping", None)
+        if stopping is not None:
+            environ[SERVER_STOPPING_KEY] = stopping
+        return environ
+
+
+class DaemonThreadPool:
+    """
+    A bounded pool of daemon worker threads, started as they are needed.
+
+    ``ThreadPoolExecutor`` joins its (non-daemon) workers when the interpreter
+    exits, so a client still connected to a stream would keep the process
+    alive after shutdown.  These workers don't block exit, as Werkzeug's
+    threaded server's threads didn't.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = "Worker"):
+        self.max_workers: int = max_workers
+        self.thread_name_prefix: str = thread_name_prefix
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._idle: threading.Semaphore = threading.Semaphore(0)
+        self._threads: List[threading.Thread] = []
+        self._shutdown: bool = False
+
+    def submit(self, fn: Callable, *args) -> None:
+        if self._shutdown:
+            raise RuntimeError("Cannot submit work after the pool has shut down")
+        self._queue.put((fn, args))
+        # Only start a new thread if none are waiting for work
+        if not self._idle.acquire(blocking=False):
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f"{self.thread_name_prefix}_{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:  # pylint: disable=W0703
+                logging.exception("Unhandled error in %s", self.thread_name_prefix)
+            del item, fn, args
+            self._idle.release()
+
+    def shutdown(self) -> None:
+        """Stop the workers once they finish their current work, without waiting"""
+        self._shutdown = True
+        for _ in self._threads:
+            self._queue.put(None)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    A Werkzeug WSGI server that handles requests on fixed thread pools.
+
+    Werkzeug's threaded server starts a new OS thread for every request.
+    This server instead hands each connection to a worker from a bounded
+    `DaemonThreadPool`, so bursts of requests queue rather than growing
+    the number of threads without limit.
+
+    Long-lived stream connections (e.g. MJPEG) are moved to a small, separate
+    pool, so that clients watching the stream can't starve short API calls.
+    Streams should end once the ``stopping`` event (also in the WSGI environ
+    as `SERVER_STOPPING_KEY`) is set by `server_close`.
+    """
+
+    multithread = True
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app,
+        max_workers: Optional[int] = None,
+        stream_workers: int = 8,
+        **kwargs
+    ) -> None:
+        kwargs.setdefault("handler", PooledWSGIRequestHandler)
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) * 4)
+        # Set up the pools first, so server_close works even if binding fails
+        self.stopping: threading.Event = threading.Event()
+        self.executor: DaemonThreadPool = DaemonThreadPool(max_workers, "WSGI")
+        self.stream_executor: DaemonThreadPool = DaemonThreadPool(
+            stream_workers, "WSGIStream"
+        )
+        super().__init__(host, port, app, **kwargs)
+
+    def process_request(self, request, client_address):
+        """Hand the connection to the main worker pool"""
+        self.executor.submit(self.dispatch_request, request, client_address)
+
+    def dispatch_request(self, request, client_address):
+        """Handle a request, or pass it on to the stream pool if it's a stream"""
+        if is_stream_request(request):
+            self.stream_executor.submit(
+                self.process_request_thread, request, client_address
+            )
+        else:
+            self.process_request_thread(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """Handle a request in a worker thread, as ThreadingMixIn does"""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=W0703
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        logging.debug("Shutting down WSGI worker pools...")
+        self.stopping.set()
+        super().server_close()
+        self.executor.shutdown()
+        self.stream_executor.shutdown()
+
+
+def is_stream_request(request: socket.socket, timeout: float = PEEK_TIMEOUT) -> bool:
+    """Peek at the request line to check if a connection is for a stream
+
+    A client that doesn't send its request line within ``timeout`` seconds is
+    treated as a normal request, rather than holding the worker indefinitely.
+    """
+    previous_timeout: Optional[float] = request.gettimeout()
+    try:
+        request.settimeout(timeout)
+        head: bytes = request.recv(256, socket.MSG_PEEK)
+    except OSError:  # Including socket.timeout
+        return False
+    finally:
+        try:
+            request.settimeout(previous_timeout)
+        except OSError:
+            pass
+    request_line: bytes = head.split(b"\r\n", 1)[0]
+    parts = request_line.split(b" ")
+    return len(parts) > 1 and parts[1].startswith(STREAMS_PATH_PREFIX)
@@ -1,7 +1,8 @@
 import errno
+import json
 import logging
 import os
-from typing import Union
+from typing import List, Union
 
 from flask import Blueprint, Flask, current_app, url_for
 from flask.views import View
@@ -16,6 +17,8 @@ __all__ = [
     "list_routes",
     "create_file",
     "init_default_extensions",
+    "find_extension_paths",
+    "V1GoneMiddleware",
 ]
 
 
@@ -62,6 +65,39 @@ def list_routes(app: Flask):
     return output
 
 
+class V1GoneMiddleware:
+    """
+    WSGI middleware answering any request to the retired v1 API with 410 Gone.
+
+    The response is built here, before Flask sets up a request context.
+    """
+
+    prefix = "/api/v1"
+    body: bytes = json.dumps(
+        {
+            "code": 410,
+            "message": "API v1 is no longer in use. Please upgrade your client.",
+            "name": "Gone",
+        },
+        separators=(",", ":"),
+    ).encode()
+    headers = [
+        ("Content-Type", "application/json"),
+        ("Content-Length", str(len(body))),
+        ("Access-Control-Allow-Origin", "*"),
+    ]
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path: str = environ.get("PATH_INFO", "")
+        if path == self.prefix or path.startswith(self.prefix + "/"):
+            start_response("410 GONE", list(self.headers))
+            return [self.body]
+        return self.wsgi_app(environ, start_response)
+
+
 def create_file(config_path: str):
     if not os.path.exists(os.path.dirname(config_path)):
         try:
@@ -72,17 +108,47 @@ def create_file(config_path: str):
 
 
 def init_default_extensions(extension_dir: str):
+    # Create the directory and any missing parents, e.g. on a fresh install
     os.makedirs(extension_dir, exist_ok=True)
 
     default_ext_path = os.path.join(extension_dir, "defaults.py")
 
-    if not os.path.isfile(default_ext_path):  # If user extensions file doesn't exist
-        logging.warning("No extension file found at %s. Creating...", (extension_dir))
-        create_file(default_ext_path)
-
-        logging.info("Populating %s...", (default_ext_path))
-        with open(default_ext_path, "w") as outfile:
-            outfile.write(_DEFAULT_EXTENSION_INIT)
+    # Exclusive create, so an existing user extensions file is left as it is
+    try:
+        outfile = open(default_ext_path, "x")
+    except FileExistsError:
+        return
+    logging.warning("No extension file found at %s. Creating...", (extension_dir))
+    logging.info("Populating %s...", (default_ext_path))
+    with outfile:
+        outfile.write(_DEFAULT_EXTENSION_INIT)
+
+
+def find_extension_paths(extension_dir: str) -> List[str]:
+    """
+    List extension files (*.py, or */__init__.py) in an extension directory.
+
+    Equivalent to the globbing done by labthings.extensions.find_extensions,
+    but from a single directory scan, using each entry's cached type.
+    """
+    module_paths: List[str] = []
+    package_paths: List[str] = []
+    try:
+        entries = os.scandir(extension_dir)
+    except FileNotFoundError:
+        logging.warning("Extension directory %s does not exist", extension_dir)
+        return []
+    with entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.name.endswith(".py") and entry.is_file():
+                module_paths.append(entry.path)
+            elif entry.is_dir():
+                init_path = os.path.join(entry.path, "__init__.py")
+                if os.path.isfile(init_path):
+                    package_paths.append(init_path)
+    return sorted(module_paths) + sorted(package_paths)
 
 
 _DEFAULT_EXTENSION_INIT = "from openflexure_microscope.api.default_extensions import *"
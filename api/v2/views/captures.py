@@ -142,6 +142,8 @@ class CaptureList(PropertyView):
         List all image captures
         """
         microscope = find_component("org.openflexure.microscope")
+        if not microscope.captures.ready.is_set():
+            abort(503, "Captures are still being loaded. Please try again shortly.")
         image_list: List[CaptureObject] = microscope.captures.images.values()
         return image_list
 
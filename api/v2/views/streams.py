@@ -1,11 +1,20 @@
-from flask import Response
+import threading
+from typing import Optional
+
+from flask import Response, request
 from labthings import find_component
 from labthings.views import PropertyView
 
+from openflexure_microscope.api.server import SERVER_STOPPING_KEY
+
+
+def gen(camera, stopping: Optional[threading.Event] = None):
+    """Video streaming generator function.
 
-def gen(camera):
-    """Video streaming generator function."""
-    while True:
+    If ``stopping`` is given, the stream ends once it is set, e.g. when the
+    server shuts down.
+    """
+    while stopping is None or not stopping.is_set():
         # the obtained frame is a jpeg
         frame: bytes = camera.stream.getframe()
 
@@ -50,8 +59,11 @@ class MjpegStream(PropertyView):
         """
         microscope = find_component("org.openflexure.microscope")
 
+        stopping: Optional[threading.Event] = request.environ.get(SERVER_STOPPING_KEY)
+
         return Response(
-            gen(microscope.camera), mimetype="multipart/x-mixed-replace; boundary=frame"
+            gen(microscope.camera, stopping),
+            mimetype="multipart/x-mixed-replace; boundary=frame",
         )
 
 
@@ -6,6 +6,7 @@ from abc import ABCMeta, abstractmethod
 from types import TracebackType
 from typing import BinaryIO, List, NamedTuple, Optional, Tuple, Type, Union
 
+import numpy as np
 from labthings import ClientEvent, StrictLock
 
 JPEG_END_BYTES: bytes = b"\xff\xd9"
@@ -74,6 +75,17 @@ class FrameStream(io.BytesIO):
         """Empty the array of tracked frame sizes"""
         self.frames = []
 
+    def tracked_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the times and sizes of the tracked frames, as arrays
+
+        The whole list of frames is converted in one go, rather than
+        looping over frames in Python.
+        """
+        frames: np.ndarray = np.array(self.frames, dtype=np.float64).reshape(-1, 2)
+        times: np.ndarray = frames[:, TrackerFrame._fields.index("time")]
+        sizes: np.ndarray = frames[:, TrackerFrame._fields.index("size")]
+        return times, sizes.astype(np.int64)
+
     def write(self, s):
         """
         Write a new frame to the FrameStream. Does a few things:
@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 import shutil
+import threading
 from collections import OrderedDict
 from typing import Dict, List, MutableMapping, Optional, Union, ValuesView
 from uuid import UUID
@@ -29,6 +30,10 @@ class CaptureManager:
         self.images: MutableMapping[str, CaptureObject] = OrderedDict()
         self.videos: MutableMapping[str, CaptureObject] = OrderedDict()
 
+        # Set once captures have been reloaded from disk
+        self.ready: threading.Event = threading.Event()
+        self._rebuild_lock: threading.Lock = threading.Lock()
+
     # FILE MANAGEMENT
 
     def __enter__(self):
@@ -59,7 +64,28 @@ class CaptureManager:
             logging.debug("Cleared %s.", (self.paths["temp"]))
 
     def rebuild_captures(self):
-        self.images = build_captures_from_exif(self.paths["default"])
+        """
+        Reload image captures from the default capture path.
+
+        Safe to run in a background thread: captures taken while the
+        directory is being scanned are kept.  `ready` is set even if
+        reloading fails, so that the captures API doesn't stay unavailable.
+        """
+        try:
+            with self._rebuild_lock:
+                existing = set(self.images.keys())
+                images = build_captures_from_exif(self.paths["default"])
+                for key, capture in list(self.images.items()):
+                    if key not in existing:
+                        images.setdefault(key, capture)
+                self.images = images
+        except Exception:
+            logging.exception(
+                "Failed to reload captures from %s", self.paths["default"]
+            )
+            raise
+        finally:
+            self.ready.set()
 
     def update_settings(self, config: dict):
         """Update settings from a config dictionary"""
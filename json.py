@@ -1,18 +1,53 @@
+import math
 from fractions import Fraction
 from uuid import UUID
 
 import numpy as np
 from labthings.json import LabThingsJSONEncoder
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __all__ = ["JSONEncoder", "LabThingsJSONEncoder"]
 
 
 class JSONEncoder(LabThingsJSONEncoder):
     """
     A custom JSON encoder, with type conversions for PiCamera fractions, Numpy integers, and Numpy arrays
+
+    If orjson is installed, compact output is encoded with it, falling back to
+    the standard library for anything orjson refuses (e.g. circular references),
+    and for NaN or infinite values, which orjson would write as null.
     """
 
+    def encode(self, o):
+        # Flask and LabThings both serialise responses through this method
+        if orjson is None or self.indent is not None:
+            return super().encode(o)
+        option = (
+            orjson.OPT_SERIALIZE_NUMPY
+            | orjson.OPT_NON_STR_KEYS
+            # Leave datetimes to default(), so Flask's HTTP date format is kept
+            | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            encoded: bytes = orjson.dumps(o, default=self.default, option=option)
+        except orjson.JSONEncodeError:
+            return super().encode(o)
+        # Only look for non-finite floats if there's a null they could have become
+        if b"null" in encoded and _contains_non_finite(o):
+            return super().encode(o)
+        return encoded.decode()
+
     def default(self, o):
+        # orjson only accepts exact tuples, so NamedTuples (e.g. a stage's move
+        # history) come here.  The standard library writes them as lists.
+        if isinstance(o, tuple):
+            return list(o)
         if isinstance(o, UUID):
             return str(o)
         # PiCamera fractions
@@ -21,8 +56,8 @@ class JSONEncoder(LabThingsJSONEncoder):
         # Numpy integers
         elif isinstance(o, np.integer):
             return int(o)
-        # Numpy floats are just Python floats
-        elif isinstance(o, float):
+        # Numpy floats (float64 is a Python float, but float32 isn't)
+        elif isinstance(o, (float, np.floating)):
             return float(o)
         # Numpy arrays
         elif isinstance(o, np.ndarray):
@@ -31,3 +66,19 @@ class JSONEncoder(LabThingsJSONEncoder):
             # call base class implementation which takes care of
             # raising exceptions for unsupported types
             return LabThingsJSONEncoder.default(self, o)
+
+
+def _contains_non_finite(o) -> bool:
+    """Check if NaN or infinity appears in the containers and arrays of a payload"""
+    if isinstance(o, (float, np.floating)):
+        return not math.isfinite(o)
+    if isinstance(o, dict):
+        return any(_contains_non_finite(value) for value in o.values())
+    if isinstance(o, (list, tuple)):
+        return any(_contains_non_finite(value) for value in o)
+    if isinstance(o, np.ndarray):
+        if o.dtype.kind in "fc":
+            return not np.isfinite(o).all()
+        if o.dtype.kind == "O":
+            return any(_contains_non_finite(value) for value in o.flat)
+    return False
@@ -6,7 +6,6 @@ import logging
 import uuid
 from typing import Dict, List, Optional, Tuple, Union
 
-import pkg_resources
 from expiringdict import ExpiringDict
 
 from openflexure_microscope.camera.base import BaseCamera
@@ -16,6 +15,7 @@ from openflexure_microscope.config import OpenflexureSettingsFile
 from openflexure_microscope.stage.base import BaseStage
 from openflexure_microscope.stage.mock import MissingStage
 from openflexure_microscope.stage.sangapi import SangaDeltaStage, SangaStagePi
+from openflexure_microscope.utilities import get_server_version
 # from openflexure_microscope.stage.sanga import SangaStagePi
 
 try:
@@ -294,9 +294,7 @@ class Microscope:
         current_configuration = {
             "application": {
                 "name": "openflexure-microscope-server",
-                "version": pkg_resources.get_distribution(
-                    "openflexure-microscope-server"
-                ).version,
+                "version": get_server_version(),
             },
             "stage": {
                 "type": self.stage.__class__.__name__,
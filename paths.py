@@ -4,7 +4,14 @@ import os
 
 
 def check_rw(path: str) -> bool:
-    return os.access(path, os.W_OK) and os.access(path, os.R_OK)
+    return os.access(path, os.R_OK | os.W_OK)
+
+
+def check_rw_dir(path: str) -> bool:
+    """Check a directory exists and we can create files in it"""
+    # A missing path fails access(), and executable files pass X_OK, so check
+    # it's a directory too (only when access() has passed)
+    return os.access(path, os.R_OK | os.W_OK | os.X_OK) and os.path.isdir(path)
 
 
 def settings_file_path(filename: str) -> str:
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+
+from openflexure_microscope.api.asgi import (
+    MJPEG_FRAME_HEADER,
+    MJPEG_STREAM_PATH,
+    SNAPSHOT_STREAM_PATH,
+    StreamsASGIApp,
+)
+
+FRAME = b"\xff\xd8fake jpeg\xff\xd9"
+
+
+class FakeStream:
+    def __init__(self):
+        self.reads = 0
+
+    def getframe(self):
+        time.sleep(0.01)
+        self.reads += 1
+        return FRAME
+
+
+async def inner_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"from the WSGI app"})
+
+
+def _scope(path, method="GET"):
+    return {"type": "http", "method": method, "path": path}
+
+
+class FakeClient:
+    """ASGI receive/send callables for one request"""
+
+    def __init__(self, disconnect_after=None):
+        self.messages = []
+        self.disconnect_after = disconnect_after
+        self.disconnected = None
+        self.requested = False
+
+    async def receive(self):
+        if not self.requested:
+            self.requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        if self.disconnected is None:
+            self.disconnected = asyncio.Event()
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        self.messages.append(message)
+        bodies = [m for m in self.messages if m["type"] == "http.response.body"]
+        if self.disconnect_after is not None and len(bodies) >= self.disconnect_after:
+            if self.disconnected is None:
+                self.disconnected = asyncio.Event()
+            self.disconnected.set()
+
+
+def _run(coroutine, timeout=5):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout))
+
+
+def test_mjpeg_stream_ends_when_client_disconnects():
+    stream = FakeStream()
+    app = StreamsASGIApp(inner_app, lambda: stream)
+    client = FakeClient(disconnect_after=3)
+    _run(app(_scope(MJPEG_STREAM_PATH), client.receive, client.send))
+
+    start, *bodies = client.messages
+    assert start["status"] == 200
+    assert (b"content-type", b"multipart/x-mixed-replace; boundary=frame") in start[
+        "headers"
+    ]
+    assert len(bodies) >= 3
+    assert bodies[0]["body"] == MJPEG_FRAME_HEADER + FRAME + b"\r\n"
+    assert bodies[0]["more_body"]
+    # The client is forgotten, so the camera is no longer read for it
+    assert app.broadcaster._clients == 0  # pylint: disable=W0212
+
+
+def test_mjpeg_streams_share_one_reader():
+    stream = FakeStream()
+    app = StreamsASGIApp(inner_app, lambda: stream)
+    clients = [FakeClient(disconnect_after=5) for _ in range(4)]
+
+    async def watch_all():
+        await asyncio.gather(
+            *[app(_scope(MJPEG_STREAM_PATH), c.receive, c.send) for c in clients]
+        )
+
+    _run(watch_all())
+    frames_sent = sum(len(c.messages) - 1 for c in clients)
+    assert stream.reads < frames_sent
+
+
+def test_stop_ends_open_streams():
+    app = StreamsASGIApp(inner_app, FakeStream)
+    client = FakeClient()
+
+    async def watch_then_stop():
+        task = asyncio.ensure_future(
+            app(_scope(MJPEG_STREAM_PATH), client.receive, client.send)
+        )
+        await asyncio.sleep(0.1)
+        threading.Thread(target=app.stop).start()
+        await task
+
+    _run(watch_then_stop())
+    # The response is finished properly
+    assert client.messages[-1] == {"type": "http.response.body", "body": b""}
+    assert len(client.messages) > 2
+
+
+def test_snapshot():
+    app = StreamsASGIApp(inner_app, FakeStream)
+    client = FakeClient()
+    _run(app(_scope(SNAPSHOT_STREAM_PATH), client.receive, client.send))
+    start, body = client.messages
+    assert start["status"] == 200
+    assert (b"content-type", b"image/jpeg") in start["headers"]
+    assert (b"content-length", str(len(FRAME)).encode()) in start["headers"]
+    assert body["body"] == FRAME
+
+
+def test_snapshot_after_stop():
+    app = StreamsASGIApp(inner_app, FakeStream)
+    app.stop()
+    client = FakeClient()
+    _run(app(_scope(SNAPSHOT_STREAM_PATH), client.receive, client.send))
+    assert client.messages[0]["status"] == 503
+
+
+def test_other_requests_go_to_the_app():
+    app = StreamsASGIApp(inner_app, FakeStream)
+    for scope in (
+        _scope("/api/v2/instrument/state"),
+        _scope(MJPEG_STREAM_PATH, method="POST"),
+        {"type": "lifespan"},
+    ):
+        client = FakeClient()
+        _run(app(scope, client.receive, client.send))
+        assert client.messages[-1]["body"] == b"from the WSGI app"
@@ -0,0 +1,410 @@
+import threading
+
+import numpy as np
+import pytest
+
+from openflexure_microscope.api.default_extensions import autofocus
+
+
+@pytest.fixture(params=["numba", "cv2", "numpy"])
+def backend(request, monkeypatch):
+    """Run a test with each of the optional sharpness backends"""
+    if request.param == "numba":
+        pytest.importorskip("numba")
+    elif request.param == "cv2":
+        pytest.importorskip("cv2")
+        monkeypatch.setattr(autofocus, "numba", None)
+    else:
+        monkeypatch.setattr(autofocus, "numba", None)
+        monkeypatch.setattr(autofocus, "cv2", None)
+    return request.param
+
+
+def _image(shape=(48, 64, 3), seed=0):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+
+def _lap2_reference(rgb_image):
+    green = rgb_image[:, :, 1].astype(float)
+    lap = (
+        4 * green[1:-1, 1:-1]
+        - green[:-2, 1:-1]
+        - green[2:, 1:-1]
+        - green[1:-1, :-2]
+        - green[1:-1, 2:]
+    )
+    return np.var(lap)
+
+
+def _edge_reference(image, n=autofocus.EDGE_KERNEL_N):
+    # The original implementation, using scipy.ndimage
+    ndimage = pytest.importorskip("scipy.ndimage")
+    gray = np.mean(image.astype(float), 2)
+    edge = np.array([[-1] * n + [1] * n])
+    return float(
+        np.sum([np.sum(ndimage.convolve(gray, W) ** 2) for W in [edge, edge.T]])
+    )
+
+
+@pytest.mark.parametrize("shape", [(48, 64, 3), (3, 3, 3), (31, 17, 3)])
+def test_sharpness_sum_lap2(backend, shape):
+    image = _image(shape)
+    assert autofocus.sharpness_sum_lap2(image) == pytest.approx(
+        _lap2_reference(image), rel=1e-6
+    )
+
+
+def test_sharpness_sum_lap2_flat_image(backend):
+    assert autofocus.sharpness_sum_lap2(np.full((20, 30, 3), 77, np.uint8)) == 0
+
+
+@pytest.mark.parametrize("shape", [(48, 64, 3), (30, 25, 3), (8, 50, 3)])
+def test_sharpness_edge(backend, shape):
+    # Includes images smaller than the kernel, so the edges are reflected
+    image = _image(shape)
+    assert autofocus.sharpness_edge(image) == pytest.approx(
+        _edge_reference(image), rel=1e-5
+    )
+
+
+def test_sharpness_edge_flat_image(backend):
+    flat = np.full((40, 50, 3), 200, np.uint8)
+    assert autofocus.sharpness_edge(flat) == pytest.approx(0, abs=1e-3)
+
+
+def test_sharpness_increases_with_detail(backend):
+    sharp = _image()
+    blurred = ((sharp[:-1].astype(int) + sharp[1:]) // 2).astype(np.uint8)
+    assert autofocus.sharpness_sum_lap2(sharp) > autofocus.sharpness_sum_lap2(blurred)
+
+
+def test_growable_array():
+    # pylint: disable=W0212
+    array = autofocus._GrowableArray(np.int64, (3,), capacity=2)
+    rows = [(i, 2 * i, 3 * i) for i in range(9)]
+    array.append(rows[0])
+    array.extend(rows[1:4])
+    for row in rows[4:]:
+        array.append(row)
+    assert len(array) == len(rows)
+    assert array.data.dtype == np.int64
+    np.testing.assert_array_equal(array.data, rows)
+
+
+def test_growable_array_empty():
+    # pylint: disable=W0212
+    array = autofocus._GrowableArray(np.float64)
+    assert len(array) == 0
+    assert array.data.shape == (0,)
+    array.extend([])
+    assert len(array) == 0
+
+
+class FakeStream:
+    def __init__(self):
+        self.tracking = False
+        self.frames = []
+
+    def start_tracking(self):
+        self.tracking = True
+
+    def stop_tracking(self):
+        self.tracking = False
+
+    def reset_tracking(self):
+        self.frames = []
+
+    def tracked_arrays(self):
+        times, sizes = zip(*self.frames) if self.frames else ((), ())
+        return np.array(times, dtype=float), np.array(sizes, dtype=np.int64)
+
+
+class FakeCamera:
+    def __init__(self):
+        self.stream = FakeStream()
+
+
+class FakeStage:
+    def __init__(self, stream):
+        self.position = (0, 0, 0)
+        self.stream = stream
+
+    def move_rel(self, displacement, **_):
+        # Pretend a few frames were streamed during the move
+        t = len(self.stream.frames) + 1.0
+        self.stream.frames.extend((t + i, 1000 + i) for i in range(3))
+        self.position = tuple(p + d for p, d in zip(self.position, displacement))
+
+
+class FakeMicroscope:
+    def __init__(self):
+        self.camera = FakeCamera()
+        self.stage = FakeStage(self.camera.stream)
+
+
+def test_monitor_records_moves():
+    m = autofocus.JPEGSharpnessMonitor(FakeMicroscope())
+    for dz in (100, -50, 10):
+        index, z = m.focus_rel(dz)
+        assert index == len(m.stage_positions) - 2
+        assert z == m.stage.position[2]
+    np.testing.assert_array_equal(m.stage_positions[:, 2], [0, 100, 100, 50, 50, 60])
+    assert m.stage_positions.dtype == np.int64
+    assert len(m.stage_times) == 6
+    assert len(m.jpeg_times) == len(m.jpeg_sizes) == 9
+    data = m.data_dict()
+    assert set(data) == {"jpeg_times", "jpeg_sizes", "stage_times", "stage_positions"}
+    np.testing.assert_array_equal(data["jpeg_sizes"], m.jpeg_sizes)
+
+
+def _recorded_monitor(stage_times, stage_zs, jpeg_times, jpeg_sizes):
+    # pylint: disable=W0212
+    m = autofocus.JPEGSharpnessMonitor(FakeMicroscope())
+    m._stage_times.extend(stage_times)
+    m._stage_positions.extend([(0, 0, z) for z in stage_zs])
+    m._jpeg_times.extend(jpeg_times)
+    m._jpeg_sizes.extend(jpeg_sizes)
+    return m
+
+
+def _move_data_reference(m, istart, istop):
+    # The original linear search, for comparison
+    jpeg_times = np.array(m.jpeg_times)
+    stage_times = np.array(m.stage_times)[istart:istop]
+    stage_zs = np.array(m.stage_positions)[istart:istop, 2]
+    start = int(np.argmax(jpeg_times > stage_times[0]))
+    stop = int(np.argmax(jpeg_times > stage_times[1]))
+    if stop < 1:
+        stop = len(jpeg_times)
+    jpeg_times = jpeg_times[start:stop]
+    return (
+        jpeg_times,
+        np.interp(jpeg_times, stage_times, stage_zs),
+        np.array(m.jpeg_sizes)[start:stop],
+    )
+
+
+@pytest.fixture
+def recorded_moves():
+    rng = np.random.default_rng(1)
+    stage_times = np.array([1.0, 2.0, 2.5, 4.0, 4.0, 6.0])
+    stage_zs = [0, 300, 300, -200, -200, 50]
+    jpeg_times = np.sort(rng.uniform(0.5, 5.5, 200))
+    jpeg_sizes = rng.integers(1000, 5000, 200)
+    return _recorded_monitor(stage_times, stage_zs, jpeg_times, jpeg_sizes)
+
+
+@pytest.mark.parametrize("istart, istop", [(0, 2), (2, 4), (0, 4), (1, 3), (4, 6)])
+def test_move_data_matches_linear_search(recorded_moves, istart, istop):
+    result = recorded_moves.move_data(istart, istop)
+    expected = _move_data_reference(recorded_moves, istart, istop)
+    for actual, wanted in zip(result, expected):
+        np.testing.assert_allclose(actual, wanted)
+
+
+@pytest.mark.parametrize("index", [0, 2])
+def test_sharpest_z_on_move(recorded_moves, index):
+    _, jz, js = _move_data_reference(recorded_moves, index, index + 2)
+    assert recorded_moves.sharpest_z_on_move(index) == pytest.approx(jz[np.argmax(js)])
+
+
+def test_move_data_without_frames():
+    m = _recorded_monitor([1.0, 2.0], [0, 100], [0.1, 0.5], [10, 20])
+    with pytest.raises(ValueError):
+        m.move_data(0)
+    with pytest.raises(ValueError):
+        m.sharpest_z_on_move(0)
+
+
+@pytest.mark.parametrize(
+    "stage_times, stage_zs",
+    [([1.0, 3.0], [0, 100]), ([1.0, 3.0, 5.0], [0, 100, 40]), ([2.0, 2.0], [7, 9])],
+)
+def test_interpolate_z(stage_times, stage_zs):
+    times = np.linspace(0, 6, 25)
+    z = autofocus.interpolate_z(times, np.array(stage_times), np.array(stage_zs))
+    np.testing.assert_allclose(z, np.interp(times, stage_times, stage_zs))
+
+
+def test_monitor_hold_records_stage_position(monkeypatch):
+    monkeypatch.setattr(autofocus.time, "sleep", lambda _: None)
+    microscope = FakeMicroscope()
+    microscope.stage.position = (10, -20, 345)
+    m = autofocus.JPEGSharpnessMonitor(microscope)
+    m.focus_rel(5)
+    index, z = m.hold(1)
+    assert (index, z) == (2, 350)
+    np.testing.assert_array_equal(
+        m.stage_positions,
+        [(10, -20, 345), (10, -20, 350), (10, -20, 350), (10, -20, 350)],
+    )
+    assert np.all(np.diff(m.stage_times) >= 0)
+
+
+def test_monitor_arrays_are_views(recorded_moves):
+    data = recorded_moves.data_dict()
+    for key in ("stage_positions", "stage_times", "jpeg_times", "jpeg_sizes"):
+        assert np.shares_memory(data[key], getattr(recorded_moves, key))
+    _, _, sizes = recorded_moves.move_data(0)
+    assert np.shares_memory(sizes, recorded_moves.jpeg_sizes)
+
+
+class FocusStage:
+    def __init__(self):
+        self.position = (0, 0, 0)
+        self.backlash = 0
+        self.lock = threading.RLock()
+
+    def move_rel(self, displacement, **_):
+        self.position = tuple(int(p + d) for p, d in zip(self.position, displacement))
+
+    def scan_z(self, dz, return_to_start=True):
+        start = self.position
+        for z in dz:
+            self.position = (start[0], start[1], start[2] + int(z))
+            yield
+        if return_to_start:
+            self.position = start
+
+
+class FocusCamera:
+    """Return images filled with the stage's z position, for `_z_metric`"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.lock = threading.RLock()
+
+    def array(self, use_video_port=False):  # pylint: disable=W0613
+        return np.full((8, 8, 3), self.stage.position[2], dtype=np.int64)
+
+
+class FocusMicroscope:
+    def __init__(self):
+        self.stage = FocusStage()
+        self.camera = FocusCamera(self.stage)
+
+
+def _z_metric(profile, measured):
+    """A sharpness metric that looks up the z encoded in each image in `profile`"""
+
+    def metric(image):
+        z = int(image[0, 0, 0])
+        measured.append(z)
+        return profile[z]
+
+    return metric
+
+
+DZ = [-300, -200, -100, 0, 100, 200, 300]
+
+
+def _run_autofocus(profile, **kwargs):
+    microscope = FocusMicroscope()
+    measured = []
+    extension = autofocus.AutofocusExtension()
+    positions, sharpnesses = extension.autofocus(
+        microscope, dz=DZ, settle=0, metric_fn=_z_metric(profile, measured), **kwargs
+    )
+    return microscope, measured, positions, sharpnesses
+
+
+def test_autofocus_sweeps_every_position_by_default():
+    profile = dict(zip(DZ, [1, 3, 10, 4, 2, 1, 1]))
+    microscope, measured, positions, sharpnesses = _run_autofocus(profile)
+    assert positions == measured == DZ
+    assert sharpnesses == [profile[z] for z in DZ]
+    assert microscope.stage.position[2] == -100
+    assert microscope.stage.backlash == 0
+
+
+def test_autofocus_early_stop_on_peaked_profile():
+    profile = dict(zip(DZ, [1, 3, 10, 4, 2, 1, 1]))
+    microscope, measured, positions, sharpnesses = _run_autofocus(
+        profile, early_stop=True
+    )
+    # Stops once the two positions after the peak are both below 70% of it
+    assert positions == measured == [-300, -200, -100, 0, 100]
+    assert sharpnesses == [profile[z] for z in positions]
+    assert microscope.stage.position[2] == -100
+
+
+def test_autofocus_early_stop_on_monotonic_profile():
+    profile = dict(zip(DZ, [1, 2, 3, 4, 5, 6, 7]))
+    microscope, measured, positions, sharpnesses = _run_autofocus(
+        profile, early_stop=True
+    )
+    assert positions == measured == DZ
+    assert sharpnesses == [profile[z] for z in DZ]
+    assert microscope.stage.position[2] == 300
+
+
+@pytest.mark.parametrize("early_stop", [False, True])
+def test_autofocus_results_are_aligned(early_stop):
+    rng = np.random.default_rng(2)
+    profile = dict(zip(DZ, rng.uniform(1, 10, len(DZ)).tolist()))
+    _, measured, positions, sharpnesses = _run_autofocus(profile, early_stop=early_stop)
+    assert positions == measured
+    assert sharpnesses == [profile[z] for z in positions]
+
+
+class ImageCamera:
+    def __init__(self, image):
+        self.image = image
+
+    def array(self, use_video_port=False):  # pylint: disable=W0613
+        return self.image
+
+
+class ImageMicroscope:
+    def __init__(self, image):
+        self.camera = ImageCamera(image)
+
+
+def _blur(image, passes):
+    """Blur an image by averaging each pixel with its neighbours, `passes` times"""
+    blurred = image.astype(float)
+    for _ in range(passes):
+        padded = np.pad(blurred, ((1, 1), (1, 1), (0, 0)), mode="edge")
+        blurred = (
+            padded[1:-1, 1:-1]
+            + padded[:-2, 1:-1]
+            + padded[2:, 1:-1]
+            + padded[1:-1, :-2]
+            + padded[1:-1, 2:]
+        ) / 5
+    return np.round(blurred).astype(np.uint8)
+
+
+def _focus_stack():
+    # A texture with features a few pixels across, like a sample in focus
+    texture = np.repeat(np.repeat(_image((24, 32, 3), seed=3), 3, 0), 3, 1)
+    return [_blur(texture, passes) for passes in (8, 5, 2, 0, 1, 4, 7)]
+
+
+@pytest.mark.parametrize(
+    "metric_fn", [autofocus.sharpness_sum_lap2, autofocus.sharpness_edge]
+)
+def test_measure_sharpness_without_downsampling(metric_fn):
+    extension = autofocus.AutofocusExtension()
+    for image in _focus_stack():
+        assert extension.measure_sharpness(
+            ImageMicroscope(image), metric_fn, downsample=1
+        ) == pytest.approx(metric_fn(image))
+
+
+@pytest.mark.parametrize(
+    "metric_fn", [autofocus.sharpness_sum_lap2, autofocus.sharpness_edge]
+)
+def test_measure_sharpness_downsampled_ranking(metric_fn):
+    extension = autofocus.AutofocusExtension()
+    stack = _focus_stack()
+    full = [
+        extension.measure_sharpness(ImageMicroscope(image), metric_fn, downsample=1)
+        for image in stack
+    ]
+    downsampled = [
+        extension.measure_sharpness(ImageMicroscope(image), metric_fn)
+        for image in stack
+    ]
+    assert np.argmax(full) == np.argmax(downsampled) == 3
+    np.testing.assert_array_equal(np.argsort(full), np.argsort(downsampled))
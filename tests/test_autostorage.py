@@ -0,0 +1,224 @@
+import os
+
+import pytest
+
+from openflexure_microscope.api.default_extensions import autostorage
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+@pytest.fixture
+def proc_files(monkeypatch):
+    monkeypatch.setattr(
+        autostorage, "PROC_MOUNTS_PATH", os.path.join(DATA_DIR, "proc_mounts")
+    )
+    monkeypatch.setattr(
+        autostorage,
+        "PROC_FILESYSTEMS_PATH",
+        os.path.join(DATA_DIR, "proc_filesystems"),
+    )
+
+
+def test_get_proc_partitions(proc_files):
+    assert autostorage.get_proc_partitions() == [
+        "/",
+        "/boot",
+        "/media/pi/USB DISK",
+        "/home/pi/usb bind",
+    ]
+
+
+def test_get_proc_partitions_unescapes_mount_points(proc_files):
+    partitions = autostorage.get_proc_partitions()
+    assert "/media/pi/USB DISK" in partitions
+    assert not any("\\040" in partition for partition in partitions)
+
+
+def test_get_proc_partitions_lists_bind_mounts(proc_files):
+    # Like psutil, a device bind-mounted in two places is listed at both
+    partitions = autostorage.get_proc_partitions()
+    assert "/media/pi/USB DISK" in partitions
+    assert "/home/pi/usb bind" in partitions
+
+
+def test_get_partitions_without_proc(monkeypatch, tmp_path):
+    pytest.importorskip("psutil")
+    monkeypatch.setattr(autostorage, "PROC_MOUNTS_PATH", str(tmp_path / "missing"))
+    monkeypatch.setattr(autostorage, "PROC_FILESYSTEMS_PATH", str(tmp_path / "missing"))
+    assert isinstance(autostorage.get_partitions(), list)
+
+
+class FakeCaptureManager:
+    def __init__(self, location):
+        self.paths = {"default": location}
+        self.rebuilds = 0
+
+    def rebuild_captures(self):
+        self.rebuilds += 1
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(autostorage.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def rw_checks(monkeypatch):
+    """Record each directory actually checked for being writeable"""
+    checked = []
+
+    def check_rw_dir(path):
+        checked.append(path)
+        return True
+
+    monkeypatch.setattr(autostorage, "check_rw_dir", check_rw_dir)
+    return checked
+
+
+@pytest.fixture
+def mounts(monkeypatch, tmp_path):
+    """A fake mount table, and the locations it makes available"""
+    usb = str(tmp_path / "usb")
+    state = {
+        "table": "/dev/sda1 / ext4 rw 0 0\n",
+        "usb": f"/dev/sdb1 {usb} vfat rw 0 0\n",
+        "usb_path": usb,
+        "scans": 0,
+    }
+    default = str(tmp_path / "default")
+    monkeypatch.setattr(autostorage, "BASE_CAPTURE_PATH", default)
+    monkeypatch.setattr(autostorage, "get_mounts_table", lambda: state["table"])
+
+    def get_all_locations(check_rw):
+        state["scans"] += 1
+        locations = {"Default": default}
+        for line in state["table"].splitlines():
+            mountpoint = line.split()[1].replace("\\040", " ")
+            if mountpoint != "/" and check_rw(mountpoint):
+                locations[mountpoint] = mountpoint + "/micrographs"
+        return locations
+
+    monkeypatch.setattr(autostorage, "get_all_locations", get_all_locations)
+    return state
+
+
+@pytest.fixture
+def extension(mounts):  # pylint: disable=W0613
+    extension = autostorage.AutostorageExtension()
+    extension.capture_manager = FakeCaptureManager(autostorage.BASE_CAPTURE_PATH)
+    return extension
+
+
+def test_check_rw_is_cached(extension, clock, rw_checks):
+    assert extension.check_rw("/media/usb")
+    assert extension.check_rw("/media/usb")
+    clock.now += autostorage.RW_CACHE_TTL - 0.1
+    assert extension.check_rw("/media/usb")
+    assert rw_checks == ["/media/usb"]
+    assert extension.check_rw("/media/other")
+    assert rw_checks == ["/media/usb", "/media/other"]
+
+
+def test_check_rw_cache_expires(extension, clock, rw_checks):
+    extension.check_rw("/media/usb")
+    clock.now += autostorage.RW_CACHE_TTL + 0.1
+    extension.check_rw("/media/usb")
+    assert rw_checks == ["/media/usb", "/media/usb"]
+
+
+def test_locations_are_cached(extension, clock, mounts):
+    first = extension.get_cached_locations()
+    clock.now += autostorage.LOCATIONS_CACHE_TTL - 0.1
+    assert extension.get_cached_locations() == first
+    assert mounts["scans"] == 1
+    # Callers get a copy, so can't change the cached locations
+    extension.get_cached_locations()["Custom"] = "/elsewhere"
+    assert "Custom" not in extension.get_cached_locations()
+
+
+def test_locations_cache_expires(extension, clock, mounts):
+    extension.get_cached_locations()
+    clock.now += autostorage.LOCATIONS_CACHE_TTL + 0.1
+    extension.get_cached_locations()
+    assert mounts["scans"] == 2
+
+
+def test_locations_cache_refreshes_on_mount(extension, clock, mounts, rw_checks):
+    usb = mounts["usb_path"]
+    assert usb not in extension.get_cached_locations()
+    mounts["table"] += mounts["usb"]
+    assert extension.get_cached_locations()[usb] == usb + "/micrographs"
+    assert rw_checks == [usb]
+
+    # Unmounting also forgets that the drive was writeable
+    mounts["table"] = mounts["table"].replace(mounts["usb"], "")
+    assert usb not in extension.get_cached_locations()
+    extension.check_rw(usb)
+    assert rw_checks == [usb, usb]
+    assert mounts["scans"] == 3
+    assert clock.now == 1000.0
+
+
+def test_set_preferred_key_clears_caches(extension, mounts, rw_checks, clock):
+    usb = mounts["usb_path"]
+    mounts["table"] += mounts["usb"]
+    extension.set_preferred_key(usb)
+    assert extension.capture_manager.paths["default"] == usb + "/micrographs"
+    assert extension.get_preferred_key() == usb
+    assert mounts["scans"] == 2
+    assert rw_checks == [usb, usb]
+    assert clock.now == 1000.0
+
+
+def test_title_to_key(extension, mounts):
+    for key in extension.get_locations():
+        assert extension.title_to_key(extension.key_to_title(key)) == key
+
+
+def test_title_to_key_with_separator_in_key(extension, mounts, rw_checks):
+    # A mount point containing " (", and another that is a prefix of it
+    mounts["table"] += "/dev/sdb1 /media/USB vfat rw 0 0\n"
+    mounts["table"] += "/dev/sdc1 /media/USB\\040(2) vfat rw 0 0\n"
+    title = extension.key_to_title("/media/USB (2)")
+    assert title == "/media/USB (2) (/media/USB (2)/micrographs)"
+    assert extension.title_to_key(title) == "/media/USB (2)"
+    assert extension.title_to_key("/media/USB (/media/USB/micrographs)") == "/media/USB"
+
+
+@pytest.mark.parametrize(
+    "title", ["Nowhere (/nowhere)", "Default", "Default (/somewhere/else)", ""]
+)
+def test_title_to_key_unknown_title(extension, title):
+    with pytest.raises(KeyError):
+        extension.title_to_key(title)
+
+
+def test_set_current_location_unchanged(tmp_path):
+    capture_manager = FakeCaptureManager(str(tmp_path))
+    autostorage.set_current_location(capture_manager, str(tmp_path))
+    assert capture_manager.rebuilds == 0
+    assert capture_manager.paths == {"default": str(tmp_path)}
+
+
+def test_set_current_location_changed(tmp_path):
+    capture_manager = FakeCaptureManager(str(tmp_path / "old"))
+    autostorage.set_current_location(capture_manager, str(tmp_path / "new"))
+    assert capture_manager.rebuilds == 1
+    assert capture_manager.paths == {"default": str(tmp_path / "new")}
+    assert (tmp_path / "new").is_dir()
+
+
+def test_reselecting_current_location(extension):
+    extension.set_preferred_key("Default")
+    assert extension.capture_manager.rebuilds == 0
+    assert extension.get_preferred_key() == "Default"
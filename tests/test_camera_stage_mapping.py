@@ -0,0 +1,210 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("camera_stage_mapping")
+PIL_Image = pytest.importorskip("PIL.Image")
+
+# pylint: disable=C0413
+from camera_stage_mapping.camera_stage_tracker import Tracker
+
+from openflexure_microscope.api.default_extensions import camera_stage_mapping
+from openflexure_microscope.config import OpenflexureSettingsFile
+from openflexure_microscope.json import JSONEncoder
+
+
+def _sample(shape=(480, 640)):
+    """A smooth, random RGB texture larger than the field of view"""
+    rng = np.random.default_rng(0)
+    noise = rng.random((shape[0] // 8, shape[1] // 8, 3))
+    image = np.kron(noise, np.ones((8, 8, 1)))
+    return (255 * image).astype(np.uint8)
+
+
+class FakeCamera:
+    def __init__(self, stage, size=(240, 320)):
+        self.stage = stage
+        self.size = size
+        self.sample = _sample()
+
+    def get_frame(self):
+        x, y = (int(p) for p in self.stage.position[:2])
+        h, w = self.size
+        frame = self.sample[100 + y : 100 + y + h, 100 + x : 100 + x + w]
+        buffer = io.BytesIO()
+        PIL_Image.fromarray(frame).save(buffer, format="JPEG", quality=95)
+        return buffer.getvalue()
+
+
+class FakeStage:
+    def __init__(self):
+        self.position = [0, 0, 0]
+
+    def move_abs(self, position):
+        self.position = list(position)
+
+
+class FakeMicroscope:
+    def __init__(self):
+        self.stage = FakeStage()
+        self.camera = FakeCamera(self.stage)
+        self.extension_settings = {}
+
+    def read_settings(self):
+        return {"extensions": self.extension_settings}
+
+
+@pytest.fixture(params=["simplejpeg", "PIL"])
+def extension(request, monkeypatch):
+    if request.param == "simplejpeg":
+        pytest.importorskip("simplejpeg")
+    else:
+        monkeypatch.setattr(camera_stage_mapping, "simplejpeg", None)
+    ext = camera_stage_mapping.CSMExtension()
+    ext._microscope = FakeMicroscope()  # pylint: disable=W0212
+    return ext
+
+
+def test_grab_image_is_grayscale(extension):
+    grab_image, _, _, _ = extension.camera_stage_functions()
+    image = grab_image()
+    assert image.shape == (240, 320)
+    assert image.dtype == np.uint8
+
+
+def test_tracker_accepts_grayscale_frames(extension):
+    grab_image, get_position, move, _ = extension.camera_stage_functions()
+    tracker = Tracker(grab_image, get_position)
+    tracker.acquire_template(settle=False)
+    move([20, 10, 0])
+    _, image_position = tracker.append_point(settle=False)
+    # The frame moves with the stage, so the sample moves the opposite way
+    assert np.allclose(np.abs(image_position), [10, 20], atol=1)
+
+
+def test_calibration_data_is_encoded_by_orjson(monkeypatch):
+    pytest.importorskip("orjson")
+    move = camera_stage_mapping.LoggingMoveWrapper(lambda position: None)
+    for position in ([0, 0, 0], np.array([100, 0, 0]), np.array([250, -5, 0])):
+        move(position)
+    history = move.history
+    data = {
+        "camera_stage_mapping_calibration": {"image_to_stage_displacement": np.eye(2)},
+        "linear_calibration_x": {"move_history": history},
+    }
+
+    def stdlib_encode(self, o):
+        raise AssertionError("JSONEncoder fell back to the standard library")
+
+    monkeypatch.setattr(json.JSONEncoder, "encode", stdlib_encode)
+    encoded = json.dumps(data, cls=JSONEncoder)
+    assert json.loads(encoded) == {
+        "camera_stage_mapping_calibration": {
+            "image_to_stage_displacement": [[1.0, 0.0], [0.0, 1.0]]
+        },
+        "linear_calibration_x": {
+            "move_history": [history.times.tolist(), history.stage_positions.tolist()]
+        },
+    }
+
+
+def test_move_history_positions_are_integers():
+    move = camera_stage_mapping.LoggingMoveWrapper(lambda position: None)
+    positions = [(0, 0, 0), np.array([100, 0, 0]), np.array([249.6, -5.2, 0.0])]
+    for position in positions:
+        move(position)
+    history = move.history
+    assert history.stage_positions.dtype == np.int64
+    np.testing.assert_array_equal(
+        history.stage_positions,
+        [[0, 0, 0], [0, 0, 0], [100, 0, 0], [100, 0, 0], [250, -5, 0]],
+    )
+    assert len(history.times) == len(history.stage_positions)
+    # Saved calibration files keep integer positions, e.g. 100 not 100.0
+    encoded = json.dumps({"move_history": history}, cls=JSONEncoder)
+    assert json.loads(encoded)["move_history"][1][2] == [100, 0, 0]
+    assert "100.0" not in encoded
+
+
+def test_move_history_grows():
+    move = camera_stage_mapping.LoggingMoveWrapper(lambda position: None)
+    n_moves = camera_stage_mapping.LoggingMoveWrapper.INITIAL_CAPACITY
+    for i in range(n_moves):
+        move((i, 2 * i, 0))
+    history = move.history
+    assert len(history.stage_positions) == 2 * n_moves - 1
+    np.testing.assert_array_equal(
+        history.stage_positions[-1], [n_moves - 1, 2 * n_moves - 2, 0]
+    )
+    move.clear_history()
+    assert len(move.history.times) == 0
+
+
+class SettingsMicroscope:
+    """Just enough of a microscope to read and write extension settings"""
+
+    def __init__(self, path):
+        self.settings_file = OpenflexureSettingsFile(str(path), defaults={})
+        self.extension_settings = {}
+        self.stage = FakeStage()
+        self.stage.moves = []
+        self.stage.move_rel = self.stage.moves.append
+        self.reads = 0
+
+    def read_settings(self):
+        self.reads += 1
+        return self.settings_file.merge({"extensions": self.extension_settings})
+
+    def update_settings(self, settings):
+        self.extension_settings.update(settings.pop("extensions", {}))
+
+    def save_settings(self):
+        self.settings_file.save(self.read_settings(), backup=False)
+
+
+@pytest.fixture
+def calibrated(tmp_path):
+    ext = camera_stage_mapping.CSMExtension()
+    microscope = SettingsMicroscope(tmp_path / "settings.json")
+    ext._microscope = microscope  # pylint: disable=W0212
+    ext.update_settings({"image_to_stage_displacement": [[1, 0], [0, 1]]})
+    return ext, microscope
+
+
+def test_settings_follow_the_microscope(calibrated):
+    ext, microscope = calibrated
+    ext.move_in_image_coordinates((1, 2))
+    reads = microscope.reads
+    ext.move_in_image_coordinates((1, 2))
+    assert microscope.reads == reads  # Cached
+    # Replaced through the microscope's settings API, e.g. a reload from disk
+    microscope.update_settings(
+        {"extensions": {ext.name: {"image_to_stage_displacement": [[2, 0], [0, 2]]}}}
+    )
+    ext.move_in_image_coordinates((1, 2))
+    assert microscope.stage.moves == [[1, 2, 0], [1, 2, 0], [2, 4, 0]]
+
+
+def test_settings_mutated_in_place(calibrated):
+    ext, microscope = calibrated
+    ext.move_in_image_coordinates((1, 2))
+    microscope.extension_settings[ext.name]["image_to_stage_displacement"] = [
+        [0, 3],
+        [3, 0],
+    ]
+    ext.move_in_image_coordinates((1, 2))
+    assert microscope.stage.moves[-1] == [6, 3, 0]
+
+
+def test_settings_reread_when_file_changes(calibrated):
+    ext, microscope = calibrated
+    ext.get_settings()
+    reads = microscope.reads
+    ext.get_settings()
+    assert microscope.reads == reads
+    with open(microscope.settings_file.path, "a") as f:
+        f.write("\n")
+    ext.get_settings()
+    assert microscope.reads == reads + 1
@@ -0,0 +1,24 @@
+import pytest
+
+from openflexure_microscope.captures import capture_manager
+from openflexure_microscope.captures.capture_manager import CaptureManager
+
+
+def test_rebuild_captures_sets_ready(tmp_path):
+    manager = CaptureManager()
+    manager.paths["default"] = str(tmp_path)
+    manager.rebuild_captures()
+    assert manager.ready.is_set()
+    assert not manager.images
+
+
+def test_rebuild_captures_sets_ready_on_error(tmp_path, monkeypatch):
+    def broken_build(path):
+        raise OSError(f"Can't read {path}")
+
+    monkeypatch.setattr(capture_manager, "build_captures_from_exif", broken_build)
+    manager = CaptureManager()
+    manager.paths["default"] = str(tmp_path)
+    with pytest.raises(OSError):
+        manager.rebuild_captures()
+    assert manager.ready.is_set()
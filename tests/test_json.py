@@ -0,0 +1,92 @@
+import json
+import math
+from collections import namedtuple
+from fractions import Fraction
+from uuid import UUID
+
+import numpy as np
+import pytest
+
+from openflexure_microscope import json as ofm_json
+from openflexure_microscope.json import JSONEncoder
+
+Point = namedtuple("Point", ["x", "y"])
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def encoder_backend(request, monkeypatch):
+    """Encode with orjson where it's installed, and with the fallback"""
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(ofm_json, "orjson", None)
+    return request.param
+
+
+def _encode(o, **kwargs):
+    return json.dumps(o, cls=JSONEncoder, **kwargs)
+
+
+def test_encode_types(encoder_backend):
+    payload = {
+        "id": UUID("12345678-1234-5678-1234-567812345678"),
+        "gain": Fraction(3, 2),
+        "count": np.int64(7),
+        "array": np.arange(3),
+        "float": np.float64(0.5),
+        "nothing": None,
+    }
+    assert json.loads(_encode(payload)) == {
+        "id": "12345678-1234-5678-1234-567812345678",
+        "gain": 1.5,
+        "count": 7,
+        "array": [0, 1, 2],
+        "float": 0.5,
+        "nothing": None,
+    }
+
+
+def test_encode_namedtuple(encoder_backend):
+    # NamedTuples are written as lists, as the standard library does
+    payload = {"point": Point(1, 2), "points": [Point(np.int64(3), 4.5)]}
+    assert json.loads(_encode(payload)) == {"point": [1, 2], "points": [[3, 4.5]]}
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"value": float("nan")},
+        {"nested": [1.0, {"value": float("inf")}]},
+        {"array": np.array([1.0, -np.inf])},
+        {"scalar": np.float32("nan")},
+        {"tuple": Point(float("nan"), 1)},
+    ],
+)
+def test_encode_non_finite(encoder_backend, payload):
+    # Non-finite values are written as NaN/Infinity, not null, so they keep
+    # their meaning when the file is read back
+    encoded = _encode(payload)
+    assert "null" not in encoded
+    assert "NaN" in encoded or "Infinity" in encoded
+
+
+def test_encode_null_without_non_finite(encoder_backend):
+    assert json.loads(_encode({"a": None, "b": [1.0, None]})) == {
+        "a": None,
+        "b": [1.0, None],
+    }
+
+
+def test_encode_sort_keys_and_indent(encoder_backend):
+    payload = {"b": 1, "a": [1, 2]}
+    encoded = _encode(payload, sort_keys=True)
+    assert encoded.index('"a"') < encoded.index('"b"')
+    assert _encode(payload, indent=2) == json.dumps(payload, indent=2)
+
+
+def test_contains_non_finite():
+    # pylint: disable=W0212
+    assert not ofm_json._contains_non_finite({"a": [1.0, 2, "nan", None]})
+    assert ofm_json._contains_non_finite({"a": [1.0, (2, math.nan)]})
+    assert not ofm_json._contains_non_finite(np.zeros((2, 2)))
+    assert ofm_json._contains_non_finite(np.array([1, None, np.inf], dtype=object))
@@ -0,0 +1,19 @@
+import os
+
+from openflexure_microscope.paths import check_rw_dir
+
+
+def test_check_rw_dir(tmp_path):
+    assert check_rw_dir(str(tmp_path))
+
+
+def test_check_rw_dir_missing(tmp_path):
+    assert not check_rw_dir(str(tmp_path / "missing"))
+
+
+def test_check_rw_dir_regular_file(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("")
+    os.chmod(path, 0o755)
+    assert os.access(path, os.R_OK | os.W_OK | os.X_OK)
+    assert not check_rw_dir(str(path))
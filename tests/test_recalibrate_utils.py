@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("picamerax")
+
+# pylint: disable=C0413
+from openflexure_microscope.api.default_extensions.picamera_autocalibrate import (
+    recalibrate_utils as ru,
+)
+
+BAYER_PATTERN = [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+
+def _bayer_array(height=64, width=96, seed=0):
+    """A raw (height, width, 3) array, with each pixel set in one plane only"""
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 1024, (height, width), dtype=np.uint16)
+    bayer_array = np.zeros((height, width, 3), dtype=np.uint16)
+    # BGGR: blue at (0, 0), green at (0, 1) and (1, 0), red at (1, 1)
+    for (dy, dx), plane in zip(BAYER_PATTERN, [2, 1, 1, 0]):
+        bayer_array[dy::2, dx::2, plane] = raw[dy::2, dx::2]
+    return bayer_array
+
+
+def _channels_reference(bayer_array):
+    # The original implementation, one channel at a time
+    channels = np.zeros(
+        (4, bayer_array.shape[0] // 2, bayer_array.shape[1] // 2),
+        dtype=bayer_array.dtype,
+    )
+    for i, offset in enumerate(BAYER_PATTERN):
+        channels[i, :, :] = np.sum(
+            bayer_array[offset[0] :: 2, offset[1] :: 2, :], axis=2
+        )
+    return channels
+
+
+@pytest.mark.parametrize("shape", [(64, 96), (2, 2), (30, 2)])
+def test_channels_from_bayer_array(shape):
+    bayer_array = _bayer_array(*shape)
+    channels = ru.channels_from_bayer_array(bayer_array)
+    assert channels.dtype == bayer_array.dtype
+    assert channels.flags.c_contiguous
+    np.testing.assert_array_equal(channels, _channels_reference(bayer_array))
+
+
+@pytest.mark.parametrize("percentile", [0, 0.5, 50, 99, 99.9, 100])
+def test_channel_percentiles(percentile):
+    channels = ru.channels_from_bayer_array(_bayer_array())
+    np.testing.assert_allclose(
+        ru.channel_percentiles(channels, percentile),
+        np.percentile(channels, percentile, axis=(1, 2)),
+    )
+
+
+def test_channel_percentiles_of_strided_view():
+    channels = ru.channels_from_bayer_array(_bayer_array())[:, ::4, ::4]
+    np.testing.assert_allclose(
+        ru.channel_percentiles(channels, 99),
+        np.percentile(channels, 99, axis=(1, 2)),
+    )
+
+
+@pytest.mark.parametrize("percentile", [0, 37, 100])
+def test_channel_percentiles_edge_cases(percentile):
+    # Single pixels, constant channels, and values at the 10-bit limits
+    single = np.array([[[0]], [[1023]], [[64]], [[500]]], dtype=np.uint16)
+    np.testing.assert_allclose(
+        ru.channel_percentiles(single, percentile), [0, 1023, 64, 500]
+    )
+    constant = np.full((4, 5, 7), 321, dtype=np.uint16)
+    np.testing.assert_allclose(ru.channel_percentiles(constant, percentile), 321)
+
+
+def test_channel_percentiles_non_integer():
+    # Anything other than unsigned integers falls back to np.percentile
+    channels = np.random.default_rng(2).normal(size=(4, 10, 10))
+    np.testing.assert_allclose(
+        ru.channel_percentiles(channels, 90),
+        np.percentile(channels, 90, axis=(1, 2)),
+    )
+
+
+def test_white_balance_from_channels():
+    channels = np.stack(
+        [np.full((6, 8), value, dtype=np.uint16) for value in (264, 464, 464, 364)]
+    )
+    # Blue, green and red are 200, 400 and 300 above the black level
+    assert ru.white_balance_from_channels(channels) == pytest.approx((4 / 3, 2))
+
+
+@pytest.fixture(params=["numba", "numpy"])
+def lst_backend(request, monkeypatch):
+    if request.param == "numba":
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(ru, "numba", None)
+    return request.param
+
+
+def _vignetted_channels(height=100, width=130):
+    y, x = np.mgrid[0:height, 0:width]
+    r2 = ((y - height / 2) / height) ** 2 + ((x - width / 2) / width) ** 2
+    channel = 64 + 800 * np.exp(-r2)
+    return np.stack([channel * scale for scale in (0.6, 1, 1, 0.8)]).astype(np.uint16)
+
+
+def test_lst_from_flat_channels(lst_backend):
+    channels = np.full((4, 100, 130), 564, dtype=np.uint16)
+    lst = ru.lst_from_channels(channels)
+    assert lst.dtype == np.uint8
+    assert lst.shape == (4, 4, 5)
+    assert np.all(lst == 32)
+
+
+def test_lst_from_channels_backends_agree(monkeypatch):
+    pytest.importorskip("numba")
+    channels = _vignetted_channels()
+    with_numba = ru.lst_from_channels(channels)
+    monkeypatch.setattr(ru, "numba", None)
+    np.testing.assert_array_equal(ru.lst_from_channels(channels), with_numba)
+
+
+def test_lst_from_channels_out(lst_backend):
+    channels = _vignetted_channels()
+    expected = ru.lst_from_channels(channels)
+    out = np.zeros_like(expected)
+    assert ru.lst_from_channels(channels, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+    # Each channel is normalised to its brightest point, which needs no gain
+    assert np.all(out.min(axis=(1, 2)) == 32)
+    assert np.all(out[:, 0, 0] > 32)
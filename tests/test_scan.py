@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from openflexure_microscope.api.default_extensions import scan
+
+
+def _grid_reference(initial, step_sizes, n_steps, style):
+    # The original, coordinate-at-a-time construction
+    arr = []
+    if style == "spiral":
+        coord = initial
+        arr.append([initial])
+        for i in range(2, n_steps[0] + 1):
+            arr.append([])
+            side_length = (2 * i) - 1
+            coord = (coord[0] - step_sizes[0], coord[1] + step_sizes[1])
+            for direction in ([1, 0], [0, -1], [-1, 0], [0, 1]):
+                for _ in range(side_length - 1):
+                    coord = (
+                        coord[0] + direction[0] * step_sizes[0],
+                        coord[1] + direction[1] * step_sizes[1],
+                    )
+                    arr[i - 1].append(coord)
+        return arr
+    for i in range(n_steps[0]):
+        arr.append(
+            [
+                (initial[0] + i * step_sizes[0], initial[1] + j * step_sizes[1])
+                for j in range(n_steps[1])
+            ]
+        )
+    if style == "snake":
+        for i, line in enumerate(arr):
+            if i % 2 != 0:
+                line.reverse()
+    return arr
+
+
+@pytest.mark.parametrize("style", ["raster", "snake", "spiral"])
+@pytest.mark.parametrize(
+    "initial, step_sizes",
+    [((0, 0), (2000, 1500)), ((-1234, 567), (1, 1)), ((10, 20), (-3, 7))],
+)
+@pytest.mark.parametrize(
+    "n_steps", [(1, 1), (2, 2), (3, 3), (4, 5), (5, 4), (1, 6), (7, 1), (0, 3), (3, 0)]
+)
+def test_construct_grid(initial, step_sizes, n_steps, style):
+    grid = scan.construct_grid(initial, step_sizes, n_steps, style)
+    expected = _grid_reference(initial, step_sizes, n_steps, style)
+    assert grid == expected
+    # Coordinates are tuples of plain ints, so they serialise as before
+    assert all(type(coord) is tuple for line in grid for coord in line)
+    assert all(type(v) is int for line in grid for coord in line for v in coord)
+
+    path = scan.construct_grid_1d(initial, step_sizes, n_steps, style)
+    assert path == [coord for line in expected for coord in line]
+
+
+def test_spiral_shells():
+    grid = scan.construct_grid((0, 0), (1, 1), (4, 4), "spiral")
+    assert [len(shell) for shell in grid] == [1, 8, 16, 24]
+    # Each shell is the square ring of that radius, visited once per point
+    for radius, shell in enumerate(grid):
+        assert len(set(shell)) == len(shell)
+        assert all(max(abs(x), abs(y)) == radius for x, y in shell)
+
+
+def test_snake_is_continuous():
+    path = np.array(scan.construct_grid_1d((0, 0), (1, 1), (5, 6), "snake"))
+    steps = np.abs(np.diff(path, axis=0)).sum(axis=1)
+    assert np.all(steps == 1)
+
+
+@pytest.mark.parametrize(
+    "position, expected",
+    [((0, 0), (0, 0, 5)), ((9, 9), (10, 10, 3)), ((5, 5), (10, 0, 4))],
+)
+def test_closest_point_in_xy(position, expected):
+    points = [(0, 0, 5), (10, 10, 3), (0, 10, 1), (10, 0, 4)]
+    # (5, 5) is equidistant from all four, so the latest point wins the tie
+    assert scan.closest_point_in_xy(position, points) == expected
+
+
+def test_closest_point_in_xy_empty():
+    assert scan.closest_point_in_xy((0, 0), []) is None
@@ -0,0 +1,136 @@
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from openflexure_microscope.api.server import (
+    DaemonThreadPool,
+    PooledWSGIServer,
+    is_stream_request,
+)
+from openflexure_microscope.api.v2.views.streams import gen
+
+
+def hello_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"hello"]
+
+
+def test_bind_failure_is_reported():
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen(1)
+        port = taken.getsockname()[1]
+        with pytest.raises(OSError) as exc_info:
+            PooledWSGIServer("127.0.0.1", port, hello_app)
+    assert not isinstance(exc_info.value, AttributeError)
+
+
+def test_daemon_thread_pool():
+    pool = DaemonThreadPool(2, "Test")
+    release = threading.Event()
+    done = []
+
+    def task(i):
+        release.wait(5)
+        done.append(i)
+
+    for i in range(5):
+        pool.submit(task, i)
+    assert len(pool._threads) == 2  # pylint: disable=W0212
+    assert all(t.daemon for t in pool._threads)  # pylint: disable=W0212
+    release.set()
+    for _ in range(100):
+        if len(done) == 5:
+            break
+        time.sleep(0.01)
+    assert sorted(done) == list(range(5))
+    pool.shutdown()
+    with pytest.raises(RuntimeError):
+        pool.submit(task, 5)
+
+
+def test_is_stream_request():
+    client, server = socket.socketpair()
+    with client, server:
+        client.sendall(b"GET /api/v2/streams/mjpeg HTTP/1.1\r\nHost: x\r\n\r\n")
+        assert is_stream_request(server)
+        # The request is still there to be read
+        assert server.recv(3) == b"GET"
+    client, server = socket.socketpair()
+    with client, server:
+        client.sendall(b"GET /api/v2/instrument/state HTTP/1.1\r\n\r\n")
+        assert not is_stream_request(server)
+
+
+def test_is_stream_request_times_out():
+    client, server = socket.socketpair()
+    with client, server:
+        server.settimeout(None)
+        start = time.monotonic()
+        assert not is_stream_request(server, timeout=0.2)
+        assert time.monotonic() - start < 2
+        # The socket's own timeout is restored
+        assert server.gettimeout() is None
+
+
+class FakeCamera:
+    class stream:  # pylint: disable=C0103
+        @staticmethod
+        def getframe():
+            time.sleep(0.01)
+            return b"frame"
+
+
+def test_gen_stops():
+    stopping = threading.Event()
+    frames = gen(FakeCamera(), stopping)
+    assert next(frames).startswith(b"--frame")
+    stopping.set()
+    assert list(frames) == []
+
+
+SERVE_STREAM_SCRIPT = textwrap.dedent("""
+    import sys, threading, time
+    from openflexure_microscope.api.server import PooledWSGIServer, SERVER_STOPPING_KEY
+
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        stopping = environ[SERVER_STOPPING_KEY]
+        def stream():
+            while True:  # Ignores stopping, like a stuck client
+                yield b"frame"
+                time.sleep(0.05)
+        return stream()
+
+    server = PooledWSGIServer("127.0.0.1", 0, app)
+    print(server.server_port, flush=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sys.stdin.readline()
+    server.shutdown()
+    server.server_close()
+    """)
+
+
+def test_open_stream_does_not_block_exit():
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVE_STREAM_SCRIPT],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    try:
+        port = int(process.stdout.readline())
+        with socket.create_connection(("127.0.0.1", port)) as client:
+            client.sendall(b"GET /api/v2/streams/mjpeg HTTP/1.1\r\nHost: x\r\n\r\n")
+            assert client.recv(64)
+            process.stdin.write("\n")
+            process.stdin.flush()
+            # The client is still connected, but the server exits anyway
+            assert process.wait(timeout=10) == 0
+    finally:
+        process.kill()
@@ -0,0 +1,28 @@
+import pkg_resources
+
+from openflexure_microscope import utilities
+
+
+def test_get_server_version_unknown(monkeypatch):
+    def missing(name):
+        raise utilities.PackageNotFoundError(name)
+
+    utilities.get_server_version.cache_clear()
+    monkeypatch.setattr(utilities, "version", missing)
+    assert utilities.get_server_version() == "0.0.0+unknown"
+    utilities.get_server_version.cache_clear()
+
+
+def test_get_server_version_without_importlib_metadata(monkeypatch):
+    class Distribution:
+        version = "1.2.3"
+
+    def get_distribution(name):
+        assert name == utilities.SERVER_DISTRIBUTION
+        return Distribution()
+
+    utilities.get_server_version.cache_clear()
+    monkeypatch.setattr(utilities, "version", None)
+    monkeypatch.setattr(pkg_resources, "get_distribution", get_distribution)
+    assert utilities.get_server_version() == "1.2.3"
+    utilities.get_server_version.cache_clear()
@@ -0,0 +1,72 @@
+import json
+import os
+
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from openflexure_microscope.api.utilities import (
+    V1GoneMiddleware,
+    find_extension_paths,
+    init_default_extensions,
+)
+
+
+def test_init_default_extensions_creates_missing_parents(tmp_path):
+    extension_dir = str(tmp_path / "extensions" / "microscope_extensions")
+    init_default_extensions(extension_dir)
+    assert os.path.isfile(os.path.join(extension_dir, "defaults.py"))
+    assert find_extension_paths(extension_dir) == [
+        os.path.join(extension_dir, "defaults.py")
+    ]
+
+
+def test_init_default_extensions_keeps_existing_file(tmp_path):
+    default_ext_path = tmp_path / "defaults.py"
+    default_ext_path.write_text("# my extensions")
+    init_default_extensions(str(tmp_path))
+    assert default_ext_path.read_text() == "# my extensions"
+
+
+def test_find_extension_paths(tmp_path):
+    (tmp_path / "b.py").write_text("")
+    (tmp_path / "a.py").write_text("")
+    (tmp_path / ".hidden.py").write_text("")
+    (tmp_path / "notes.txt").write_text("")
+    (tmp_path / "package").mkdir()
+    (tmp_path / "package" / "__init__.py").write_text("")
+    (tmp_path / "not_a_package").mkdir()
+    assert find_extension_paths(str(tmp_path)) == [
+        str(tmp_path / "a.py"),
+        str(tmp_path / "b.py"),
+        str(tmp_path / "package" / "__init__.py"),
+    ]
+
+
+def test_find_extension_paths_missing_directory(tmp_path):
+    assert find_extension_paths(str(tmp_path / "missing")) == []
+
+
+@pytest.fixture
+def v1_client():
+    def app(environ, start_response):
+        return Response("ok")(environ, start_response)
+
+    return Client(V1GoneMiddleware(app), Response)
+
+
+@pytest.mark.parametrize("path", ["/api/v1", "/api/v1/", "/api/v1/instrument/state"])
+def test_v1_gone(v1_client, path):
+    response = v1_client.get(path)
+    assert response.status_code == 410
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.headers["Access-Control-Allow-Origin"] == "*"
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    assert json.loads(response.data)["code"] == 410
+
+
+@pytest.mark.parametrize("path", ["/", "/api/v2/instrument/state", "/api/v10"])
+def test_v1_gone_passes_other_paths(v1_client, path):
+    response = v1_client.get(path)
+    assert response.status_code == 200
+    assert response.data == b"ok"
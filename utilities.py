@@ -1,5 +1,6 @@
 import base64
 import copy
+import functools
 import logging
 import sys
 import time
@@ -14,6 +15,22 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import TypedDict
 
+# importlib.metadata was added in 3.8. Use the importlib_metadata backport for <3.8
+# if it's installed, otherwise get_server_version falls back to pkg_resources
+if sys.version_info >= (3, 8):
+    from importlib.metadata import (  # pylint: disable=no-name-in-module
+        PackageNotFoundError,
+        version,
+    )
+else:
+    try:
+        from importlib_metadata import PackageNotFoundError, version
+    except ImportError:
+        PackageNotFoundError = None
+        version = None
+
+SERVER_DISTRIBUTION: str = "openflexure-microscope-server"
+
 
 class Timer(object):
     def __init__(self, name: str):
@@ -29,6 +46,24 @@ class Timer(object):
         logging.debug("%s time: %s", self.name, self.end - self.start)
 
 
+@functools.lru_cache(maxsize=None)
+def get_server_version() -> str:
+    """Return the installed version of the microscope server package"""
+    if version is None:
+        import pkg_resources  # pylint: disable=C0415
+
+        try:
+            return pkg_resources.get_distribution(SERVER_DISTRIBUTION).version
+        except pkg_resources.DistributionNotFound:
+            logging.warning("Unable to find the installed server version.")
+            return "0.0.0+unknown"
+    try:
+        return version(SERVER_DISTRIBUTION)
+    except PackageNotFoundError:
+        logging.warning("Unable to find the installed server version.")
+        return "0.0.0+unknown"
+
+
 JSONArrayType = TypedDict(
     "JSONArrayType",
     {"@type": str, "base64": str, "dtype": str, "shape": Tuple[int, ...]},